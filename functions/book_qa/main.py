@@ -15,7 +15,9 @@ Both phases select ONLY work that has not been done at the current version. A no
 nothing and returns in seconds. Bumping PIPELINE_VERSION or QA_VERSION is how a prompt, model or
 rubric change is rolled out, and the corpus converges over however many nights it needs.
 
-POST body (all optional): {"dryRun": true, "onlyChat": "<id>", "force": true, "budgetSeconds": n}
+POST body (all optional): {"dryRun": true, "onlyChat": "<id>", "force": true, "budgetSeconds": n,
+                           "reuse": false}
+"force" also turns off incremental finalize, so a forced book is rebuilt in full.
 """
 import datetime
 import os
@@ -37,8 +39,10 @@ import pipeline
 PROJECT = os.getenv("PROJECT_ID") or pipeline.PROJECT_ID
 USER_ID = os.getenv("BOOK_QA_USER_ID", pipeline.USER_ID)
 
-# Bump to re-translate every book on the next run. Change this when the sheet prompt, the page
-# instruction, the history window or the model changes.
+# Bump to re-finalize every book on the next run. Change this when the sheet prompt, the page
+# instruction, the history window or the model changes. It is part of every stored fingerprint
+# (pipeline.call_config), so a bump redoes each page and sheet; between bumps only work whose inputs
+# changed is redone. Send "reuse": false to redo it all without a bump.
 PIPELINE_VERSION = 1
 # Bump to re-review every book without re-translating. Change this when a check or rubric changes.
 QA_VERSION = 2
@@ -104,6 +108,11 @@ def survey(only_chat=None):
             "pages": len(photos), "quiet": quiet,
             "needsFinalize": (fin.get("version", 0) < PIPELINE_VERSION
                               or fin.get("pageCount") != len(photos)),
+            # Finalized at this version and only gained pages since: translate the new pages and
+            # whatever the revised sheet reaches, not the whole book (pipeline.process_chat).
+            "incremental": (fin.get("version", 0) >= PIPELINE_VERSION
+                            and 0 < (fin.get("pageCount") or 0) < len(photos)
+                            and bool(d.get("bookSheet"))),
             # a re-translation invalidates the previous review
             "needsReview": (qa.get("version", 0) < QA_VERSION
                             or qa.get("finalizeVersion") != fin.get("version")
@@ -239,6 +248,7 @@ def book_qa(request):
     do_backfill = bool(body.get("backfill"))
     only_chat = body.get("onlyChat")
     force = bool(body.get("force"))
+    reuse = body.get("reuse", True) is not False
     deadline = time.monotonic() + int(body.get("budgetSeconds") or DEFAULT_BUDGET_S)
     started = datetime.datetime.now(datetime.timezone.utc)
     lines = []
@@ -269,9 +279,12 @@ def book_qa(request):
                 if time.monotonic() > deadline:
                     report["truncated"] = True
                     break
-                log(f"finalize {b['id'][:10]} '{b['title']}' ({b['pages']} pages)")
+                incremental = b["incremental"] and not force
+                log(f"finalize {b['id'][:10]} '{b['title']}' ({b['pages']} pages"
+                    f"{', incremental' if incremental else ''})")
                 st = pipeline.process_chat(db, b["id"], templates, pipeline.DEFAULT_MODEL,
-                                           backup_dir, not dry_run, {}, log=log)
+                                           backup_dir, not dry_run, {}, log=log, reuse=reuse,
+                                           incremental=incremental, version=PIPELINE_VERSION)
                 if not dry_run and not st.get("skipped"):
                     _conversations().document(b["id"]).update({"finalize": {
                         "version": PIPELINE_VERSION, "at": firestore.SERVER_TIMESTAMP,
@@ -279,10 +292,21 @@ def book_qa(request):
                         "sheetTerms": st.get("sheet_terms", 0),
                         "sheetRefrains": st.get("sheet_refrains", 0),
                         "drift": len(st.get("drift") or []),
+                        "boundaryDrift": sum(1 for seam in st.get("boundary_drift") or []
+                                             if seam["drift"]),
+                        "pagesReused": st.get("pages_reused", 0),
+                        "incremental": bool(st.get("incremental")),
+                        "sheetChanges": len(st.get("sheet_changes") or []),
+                        "sheetReused": bool(st.get("sheet_reused")),
                         "status": "ok" if not st.get("errors") else "errors"}})
                 report["finalized"].append({"chatId": b["id"], "title": b["title"],
                                             "pages": st.get("pages"), "errors": st.get("errors"),
-                                            "sheetTerms": st.get("sheet_terms")})
+                                            "pagesReused": st.get("pages_reused"),
+                                            "incremental": bool(st.get("incremental")),
+                                            "newPages": st.get("new_pages"),
+                                            "touchedPages": st.get("touched_pages"),
+                                            "sheetTerms": st.get("sheet_terms"),
+                                            "usage": st.get("usage"), "ocr": st.get("ocr")})
 
         for b in todo_r:
             if time.monotonic() > deadline:
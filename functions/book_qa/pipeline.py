@@ -29,6 +29,8 @@ WHAT IT DOES, PER CHAT
   4. PASS TWO — translate each page with the sheet pinned into the system prompt, plus a short
      history window and an explicit per-page instruction. The old path sent an empty user message
      on image turns, so the only instruction in a 70-page chat was the first turn's one-liner.
+     The book runs as segments of ~SEGMENT_PAGES pages in parallel; the sheet is what keeps them
+     agreeing, and the refrain check is repeated at every seam.
   5. Write the result onto an assistant doc that is bound to its page with `replyTo`, timestamped
      1 ms after its photo, with the previous text kept in `contentBeforeRebuild`.
   6. Leave the conversation turns between pages alone (corrections and questions you typed), just
@@ -47,8 +49,10 @@ Usage:
 import base64
 import concurrent.futures as cf
 import datetime
+import hashlib
 import json
 import pathlib
+import re
 import threading
 import time
 import urllib.request
@@ -68,6 +72,10 @@ MAX_RETRIES = 3
 # thinking spends from the SAME budget as the answer — at 8000, claude-sonnet-5 came back with
 # stop_reason='max_tokens', 8000 tokens of thinking and ZERO text on 11 of 24 benchmark pages.
 MAX_TOKENS = {"anthropic": 128000, "gemini": 65536}
+# The rest of each provider's call settings for the sheet and page calls. Part of every
+# fingerprint (call_config), so changing one here redoes the work it affects.
+CALL_PARAMS = {"anthropic": {"thinking": {"type": "adaptive"}, "output_config": {"effort": "max"}},
+               "gemini": {}}
 
 # Provider registry. The benchmark field is vision-capable Claude + Gemini; MaaS models on Vertex
 # take text only and cannot read a page photo.
@@ -95,6 +103,25 @@ PAGE_INSTRUCTION = ("The text is printed on the attached photo of a single page
 # register consistent. It was measured over runs of at most 5 prior pages, so the window stays in
 # that regime instead of dragging 70 photos into a 71-page book's last call.
 HISTORY_PAGES = 4
+# The window moves in strides of this many pages rather than one, so it holds HISTORY_PAGES to
+# HISTORY_PAGES + HISTORY_STRIDE - 1 pages (4-5, still inside the measured regime). A window that
+# slides by one page changes its first message on every call and no cached prefix past the system
+# prompt ever matches; one that holds still reuses the previous page's whole request as its cached
+# prefix. See history_window.
+HISTORY_STRIDE = 2
+
+# Pass 2 runs the book as independent segments of about this many pages, concurrently. Inside a
+# segment pages go in order with the history window as before; a segment's first page has no
+# history, so it is seeded instead with the source text of the SEGMENT_OVERLAP pages before it —
+# the book sheet already pins the wording that has to agree across segments. Wall time then
+# scales with the segment, not the book: a 70-page book at effort=max took over an hour page by
+# page. With history_pages=0 every page is its own segment.
+SEGMENT_PAGES = 10
+SEGMENT_OVERLAP = 2
+SEGMENT_WORKERS = 8
+SEGMENT_SEED = ("This page continues the book part-way through. For context only, this is the "
+                "source text of the page(s) just before it, which are translated separately — "
+                "do not translate them here:")
 
 _lock = threading.Lock()
 _clients = {}
@@ -116,9 +143,152 @@ def _gemini():
         return _clients["gem"]
 
 
-def translate_page(model_id, system, instruction, image_bytes, mime="image/jpeg", history=()):
+def history_window(history, history_pages, stride=HISTORY_STRIDE):
+    """The slice of `history` (every translated page so far, oldest first) sent with the next page.
+
+    The start only moves in `stride` steps, so consecutive pages share it and each request is the
+    previous one plus one exchange — exactly the prefix the previous request wrote to the cache.
+    """
+    if not history_pages:
+        return ()
+    return tuple(history[window_start(len(history), history_pages, stride):])
+
+
+def window_start(n_history, history_pages, stride=HISTORY_STRIDE):
+    start = max(0, n_history - history_pages)
+    return start - start % max(1, stride)
+
+
+def next_reads_tail(n_history, history_pages, stride=HISTORY_STRIDE):
+    """Whether the page after this one (sent with `n_history` pages of history) keeps the same
+    window start, and so reads back this request's end as its cached prefix."""
+    return bool(history_pages) and (window_start(n_history + 1, history_pages, stride)
+                                    == window_start(n_history, history_pages, stride))
+
+
+def plan_segments(page_numbers, history_pages, segment_pages=SEGMENT_PAGES):
+    """Split the book's pages, in order, into near-equal runs of at most `segment_pages` for
+    process_chat's pass 2. Stateless runs (history_pages=0) get one page per segment."""
+    if not history_pages:
+        return [[p] for p in page_numbers]
+    if segment_pages <= 0 or len(page_numbers) <= segment_pages:
+        return [list(page_numbers)] if page_numbers else []
+    n = -(-len(page_numbers) // segment_pages)
+    size, extra = divmod(len(page_numbers), n)
+    out, at = [], 0
+    for i in range(n):
+        step = size + (1 if i < extra else 0)
+        out.append(list(page_numbers[at:at + step]))
+        at += step
+    return out
+
+
+def seeded_instruction(instruction, page_texts, before):
+    """`instruction` for a segment's first page, preceded by the source text of pages `before`."""
+    seed = "\n\n".join(f"PAGE {p}\n{page_texts[p].strip()}" for p in before
+                        if (page_texts.get(p) or "").strip())
+    return f"{SEGMENT_SEED}\n\n{seed}\n\n{instruction}" if seed else instruction
+
+
+# check_refrains skips source keys shorter than this (see there).
+MIN_REFRAIN_KEY = 5
+CJK = re.compile(r"[\u3400-\u9fff\uf900-\ufaff\U00020000-\U0003134f]")
+
+
+def source_key(source):
+    """The match key for a sheet entry's source phrase: its first alternative, lower-cased."""
+    return (source or "").split("/")[0].split("[")[0].strip().lower()
+
+
+def mentions(text, key):
+    """Whether page `text` uses the source `key`. Latin keys match whole words only — 'fox' is
+    not in 'foxglove', nor 'no' in 'know' — so a short name is still found where it appears; Han
+    has no word breaks, so a Han key matches anywhere."""
+    if not key or not text:
+        return False
+    if CJK.search(key):
+        return key in text
+    return re.search(rf"\b{re.escape(key)}\b", text, re.I) is not None
+
+
+def touched_pages(page_texts, changes):
+    """The pages whose source uses an entry of `changes` (sheet_changes)."""
+    keys = [k for k in (source_key(c["source"]) for c in changes) if k]
+    return {p for p, t in page_texts.items() if any(mentions(t, k) for k in keys)}
+
+
+def sheet_changes(old, new):
+    """Sheet entries whose fixed rendering a page translated under `old` may now contradict:
+    [{"kind", "source", "before", "after"}] for every term or refrain of `new` that `old` lacked
+    or rendered differently. Entries `new` dropped are not listed — the page text is still
+    good."""
+    def entries(sheet):
+        return {(kind, source_key(item.get("source"))): (item.get("source") or "", item.get("yue") or "")
+                for kind in ("terms", "refrains") for item in (sheet or {}).get(kind, [])
+                if source_key(item.get("source"))}
+    before, out = entries(old), []
+    for key, (source, yue) in entries(new).items():
+        was = before.get(key, (None, None))[1]
+        if was is None or was.strip() != yue.strip():
+            out.append({"kind": key[0], "source": source, "before": was, "after": yue})
+    return out
+
+
+def fingerprint(*parts):
+    """sha256 over `parts` — str, bytes, or nested tuples/lists of them — in order."""
+    h = hashlib.sha256()
+
+    def feed(x):
+        if isinstance(x, (tuple, list)):
+            h.update(b"[%d" % len(x))
+            for y in x:
+                feed(y)
+            h.update(b"]")
+            return
+        data = x if isinstance(x, bytes) else str(x).encode("utf-8")
+        h.update(b"%d:" % len(data) + data)
+    feed(parts)
+    return h.hexdigest()
+
+
+def call_config(model_id, version=""):
+    """What a call depends on besides its prompt: the model, its settings (MAX_TOKENS,
+    CALL_PARAMS) and the caller's pipeline `version`, which a deliberate rollout bumps."""
+    provider = MODELS[model_id][0]
+    return (model_id, MAX_TOKENS[provider], json.dumps(CALL_PARAMS[provider], sort_keys=True),
+            str(version))
+
+
+def page_fingerprint(model_id, system, instruction, image_bytes, history, version=""):
+    """Everything translate_page is given for one page: the call config, the system prompt with its
+    sheet addendum, the page instruction, the photo, and every history photo, instruction and
+    output. A page whose stored fingerprint matches would be asked exactly the same question
+    again."""
+    return fingerprint(call_config(model_id, version),
+                       hashlib.sha256(system.encode("utf-8")).hexdigest(), instruction,
+                       hashlib.sha256(image_bytes).hexdigest(),
+                       [(hashlib.sha256(h_img).hexdigest(), h_instr, h_out)
+                        for h_img, _, h_instr, h_out in history])
+
+
+def add_usage(total, usage):
+    for k, v in usage.items():
+        total[k] = total.get(k, 0) + (v or 0)
+    return total
+
+
+def translate_page(model_id, system, instruction, image_bytes, mime="image/jpeg", history=(),
+                   usage=None, on_start=None, cache_tail=True):
     """Translate one page. `history` = [(image_bytes, mime, instruction, previous_output)] for the
-    preceding pages, newest last. Returns the translation text; raises after MAX_RETRIES."""
+    preceding pages, newest last. Returns the translation text; raises after MAX_RETRIES.
+
+    Claude calls carry up to two cache breakpoints: the system prompt (template + sheet, the same
+    for every page of the book) and, with `cache_tail`, the end of this request — worth its write
+    premium only when the next page's history_window starts at the same page (next_reads_tail).
+    Gemini caches implicitly. When `usage` is a dict, the call's input/output/cache_read/
+    cache_creation tokens are added into it. `on_start` is called once, when the first response
+    begins — by then the prompt's cache entries are written.
+    """
     provider, vertex_id = MODELS[model_id]
 
     def ant_blocks():
@@ -132,7 +302,8 @@ def translate_page(model_id, system, instruction, image_bytes, mime="image/jpeg"
         msgs.append({"role": "user", "content": [
             {"type": "image", "source": {"type": "base64", "media_type": mime,
                                          "data": base64.b64encode(image_bytes).decode()}},
-            {"type": "text", "text": instruction}]})
+            {"type": "text", "text": instruction,
+             **({"cache_control": {"type": "ephemeral"}} if cache_tail else {})}]})
         return msgs
 
     last = None
@@ -143,13 +314,20 @@ def translate_page(model_id, system, instruction, image_bytes, mime="image/jpeg"
                 # whose max_tokens could take over 10 minutes.
                 with _anthropic().messages.stream(
                         model=vertex_id, max_tokens=MAX_TOKENS["anthropic"],
-                        system=[{"type": "text", "text": system}],
-                        thinking={"type": "adaptive"},
-                        output_config={"effort": "max"},
-                        messages=ant_blocks()) as st:
+                        system=[{"type": "text", "text": system,
+                                 "cache_control": {"type": "ephemeral"}}],
+                        messages=ant_blocks(), **CALL_PARAMS["anthropic"]) as st:
                     for _ in st:
-                        pass
+                        if on_start:
+                            on_start()
+                            on_start = None
                     msg = st.get_final_message()
+                if usage is not None:
+                    u = msg.usage
+                    add_usage(usage, {"input_tokens": u.input_tokens,
+                                      "output_tokens": u.output_tokens,
+                                      "cache_read_tokens": getattr(u, "cache_read_input_tokens", 0),
+                                      "cache_creation_tokens": getattr(u, "cache_creation_input_tokens", 0)})
                 text = "".join(b.text for b in msg.content
                                if getattr(b, "type", None) == "text").strip()
                 if not text and getattr(msg, "stop_reason", None) == "max_tokens":
@@ -171,6 +349,13 @@ def translate_page(model_id, system, instruction, image_bytes, mime="image/jpeg"
                 model=vertex_id, contents=contents,
                 config=types.GenerateContentConfig(system_instruction=system,
                                                    max_output_tokens=MAX_TOKENS["gemini"]))
+            if usage is not None and r.usage_metadata:
+                um = r.usage_metadata
+                cached = um.cached_content_token_count or 0
+                add_usage(usage, {"input_tokens": (um.prompt_token_count or 0) - cached,
+                                  "output_tokens": (um.candidates_token_count or 0)
+                                                   + (um.thoughts_token_count or 0),
+                                  "cache_read_tokens": cached, "cache_creation_tokens": 0})
             return (r.text or "").strip()
         except Exception as e:  # noqa: BLE001
             last = e
@@ -227,15 +412,73 @@ Return ONLY JSON, no quotation marks inside any value:
  "refrains":[{"source":"...","yue":"..."}]}"""
 
 
+# OCR results are cached in Firestore (chats/<uid>/ocrCache), one doc per page photo, keyed by
+# the photo's bytes, the OCR model and the instruction. A photo never changes once uploaded, so a
+# re-finalize — after a sheet or translation prompt bump — reads every page's text back instead of
+# re-OCRing the whole book. Editing OCR_INSTRUCTION or OCR_MODEL changes OCR_VERSION, and with it
+# every key.
+OCR_MODEL = "gemini-3.5-flash"
+OCR_VERSION = hashlib.sha256(f"{OCR_MODEL}\n{OCR_INSTRUCTION}".encode("utf-8")).hexdigest()[:12]
+
+
 def ocr_page(image_bytes, mime="image/jpeg"):
     from google.genai import types
     r = _gemini().models.generate_content(
-        model="gemini-3.5-flash",
+        model=OCR_MODEL,
         contents=[types.Part.from_bytes(data=image_bytes, mime_type=mime), OCR_INSTRUCTION],
         config=types.GenerateContentConfig(temperature=0, max_output_tokens=2000))
     return (r.text or "").strip()
 
 
+def ocr_cache_key(image_bytes):
+    return f"{hashlib.sha256(image_bytes).hexdigest()}-{OCR_VERSION}"
+
+
+def _ocr_cache(db):
+    return db.collection("chats").document(USER_ID).collection("ocrCache")
+
+
+def ocr_pages(db, page_imgs, write=True, log=print, workers=6):
+    """{page: (image_bytes, mime)} -> ({page: text}, counts), reading the OCR cache first.
+
+    Only cache misses reach the model; their results are written back when `write` is set. A page
+    whose OCR fails comes back as "" and is not cached. counts = {"cached", "ocr", "failed"}.
+    """
+    keys = {p: ocr_cache_key(img) for p, (img, _) in page_imgs.items()}
+    cached = {}
+    if db is not None and keys:
+        try:
+            for snap in db.get_all([_ocr_cache(db).document(k) for k in set(keys.values())]):
+                if snap.exists and (snap.to_dict() or {}).get("text"):
+                    cached[snap.id] = snap.to_dict()["text"]
+        except Exception as e:  # noqa: BLE001
+            log(f"  OCR cache unreadable ({type(e).__name__}: {str(e)[:60]}) — OCRing every page")
+    page_texts = {p: cached[k] for p, k in keys.items() if k in cached}
+    counts = {"cached": len(page_texts), "ocr": 0, "failed": 0}
+    todo = {p: v for p, v in page_imgs.items() if p not in page_texts}
+    with cf.ThreadPoolExecutor(max_workers=workers) as ex:
+        futs = {ex.submit(ocr_page, img, mime): p for p, (img, mime) in todo.items()}
+        for f in cf.as_completed(futs):
+            p = futs[f]
+            try:
+                page_texts[p] = f.result()
+                counts["ocr"] += 1
+            except Exception as e:  # noqa: BLE001
+                log(f"  OCR failed on page {p}: {str(e)[:60]}")
+                page_texts[p] = ""
+                counts["failed"] += 1
+                continue
+            if write and db is not None and page_texts[p]:
+                try:
+                    _ocr_cache(db).document(keys[p]).set({
+                        "text": page_texts[p], "imageSha256": keys[p].split("-")[0],
+                        "model": OCR_MODEL, "instructionVersion": OCR_VERSION,
+                        "at": firestore.SERVER_TIMESTAMP})
+                except Exception as e:  # noqa: BLE001
+                    log(f"  OCR cache write failed on page {p}: {str(e)[:60]}")
+    return page_texts, counts
+
+
 def build_book_sheet(model_id, title, page_texts, palette=(), log=print, extra=""):
     """One pass over the WHOLE book before any page is translated.
 
@@ -262,9 +505,9 @@ def build_book_sheet(model_id, title, page_texts, palette=(), log=print, extra="
                 with _anthropic().messages.stream(
                         model=vertex_id, max_tokens=MAX_TOKENS["anthropic"],
                         system=[{"type": "text", "text": SHEET_SYSTEM}],
-                        thinking={"type": "adaptive"}, output_config={"effort": "max"},
                         messages=[{"role": "user", "content": [{"type": "text",
-                                   "text": f"Book: {title}\n\n{body}"}]}]) as st:
+                                   "text": f"Book: {title}\n\n{body}"}]}],
+                        **CALL_PARAMS["anthropic"]) as st:
                     for _ in st:
                         pass
                     m = st.get_final_message()
@@ -555,7 +798,23 @@ def strip_asides(db, chat_id, backup_dir, apply, log=print):
 
 
 def process_chat(db, chat_id, templates, model_id, backup_dir, apply, img_cache,
-                 delete_surplus=False, history_pages=HISTORY_PAGES, log=print):
+                 delete_surplus=False, history_pages=HISTORY_PAGES, log=print,
+                 segment_pages=SEGMENT_PAGES, reuse=True, incremental=False, version=""):
+    """Rebuild one book chat from its page photos (see the module docstring).
+
+    With `reuse`, work whose inputs have not changed since the last rebuild is not redone: the
+    stored bookSheet is kept when its bookSheetFingerprint still matches (model, title, page texts,
+    palette, sheet prompt), and a page whose stored inputFingerprint matches (page_fingerprint)
+    keeps its text without a model call. Reused pages still feed the history of the pages after
+    them, so an unchanged book costs only the OCR cache reads. `version` (book_qa's
+    PIPELINE_VERSION) goes into both fingerprints, so bumping it redoes everything.
+
+    `incremental` is for a finalized book that has since gained pages. The sheet is rebuilt with
+    the stored one supplied as the decisions to keep, and diffed against it (sheet_changes). Only
+    pages with no rebuilt translation yet, and pages whose source carries a term or refrain whose
+    rendering changed, are translated, each with its real history — the stored translations of
+    the pages before it. Every other page keeps its text as it is.
+    """
     chat_ref = db.collection("chats").document(USER_ID).collection("conversations").document(chat_id)
     chat_doc = chat_ref.get().to_dict() or {}
     title = chat_doc.get("title", "(untitled)")
@@ -604,25 +863,47 @@ def process_chat(db, chat_id, templates, model_id, backup_dir, apply, img_cache,
     for page, u_snap, u_data, a_snap in pages:
         page_imgs[page] = (fetch_image(u_data["image"]["url"], img_cache),
                            u_data["image"].get("type", "image/jpeg"))
-    page_texts = {}
-    with cf.ThreadPoolExecutor(max_workers=6) as ex:
-        futs = {ex.submit(ocr_page, img, mime): p for p, (img, mime) in page_imgs.items()}
-        for f in cf.as_completed(futs):
-            try:
-                page_texts[futs[f]] = f.result()
-            except Exception as e:  # noqa: BLE001
-                log(f"  [{chat_id[:10]}] OCR failed on page {futs[f]}: {str(e)[:60]}")
-                page_texts[futs[f]] = ""
+    page_texts, stats["ocr"] = ocr_pages(db, page_imgs, write=apply,
+                                         log=lambda m: log(f"  [{chat_id[:10]}]{m}"))
+    log(f"  [{chat_id[:10]}] pass 1 OCR: {stats['ocr']['cached']} page(s) from cache, "
+        f"{stats['ocr']['ocr']} OCR'd, {stats['ocr']['failed']} failed")
     palette = vivid_palette(log=lambda m: log(f"  [{chat_id[:10]}]{m}"))
     slog = lambda m: log(f"  [{chat_id[:10]}]{m}")   # noqa: E731
-    sheet = build_book_sheet(model_id, title, page_texts, palette, log=slog)
-    unreadable = unreadable_terms(sheet)
+    # The text each page's doc holds from an earlier rebuild, when that doc answers this photo.
+    existing = {}
+    for p, u_snap, _, a_snap in pages:
+        prev = (a_snap.to_dict() or {}) if a_snap is not None else {}
+        if prev.get("replyTo") == u_snap.id and prev.get("rebuiltAt") and prev.get("content"):
+            existing[p] = prev["content"]
+    old_sheet = chat_doc.get("bookSheet")
+    incremental = bool(incremental and old_sheet and existing)
+
+    sheet_fp = fingerprint(call_config(model_id, version), title, SHEET_SYSTEM,
+                           sorted(page_texts.items()), palette)
+    stats["sheet_reused"] = bool(reuse and old_sheet
+                                 and chat_doc.get("bookSheetFingerprint") == sheet_fp)
+    keep = ""
+    if stats["sheet_reused"]:
+        sheet = old_sheet
+        slog("  book sheet: inputs unchanged — reusing the stored sheet")
+    elif incremental:
+        keep = ("This book was already translated with the sheet below and has since gained "
+                "pages. Keep every decision in it unless the new pages make one clearly wrong; "
+                "add entries only for what the new pages repeat.\n"
+                + json.dumps(old_sheet, ensure_ascii=False) + "\n\n")
+        sheet = build_book_sheet(model_id, title, page_texts, palette, log=slog, extra=keep)
+        if not sheet:
+            slog("  incremental sheet failed — keeping the stored sheet")
+            sheet = old_sheet
+    else:
+        sheet = build_book_sheet(model_id, title, page_texts, palette, log=slog)
+    unreadable = unreadable_terms(sheet) if not stats["sheet_reused"] else []
     if unreadable:
         names = ", ".join(f"{i.get('yue','')} ({m})" for i, m in unreadable)
         slog(f"  sheet uses characters the Visual Font has no glyph for: {names} — asking again")
         sheet = build_book_sheet(
             model_id, title, page_texts, palette, log=slog,
-            extra=("A previous attempt used these renderings, which contain characters the "
+            extra=(keep + "A previous attempt used these renderings, which contain characters the "
                    f"reader's font has no glyph for, so they lose their jyutping: {names}. "
                    "Choose different wording built from characters the font covers."))
         still = unreadable_terms(sheet)
@@ -634,57 +915,171 @@ def process_chat(db, chat_id, templates, model_id, backup_dir, apply, img_cache,
     stats["sheet_refrains"] = len(sheet.get("refrains", [])) if sheet else 0
     stats["_sheet"] = sheet
     stats["_page_texts"] = page_texts
+    stats["incremental"] = incremental
 
     # --- pass 2: translate each page, pinned by the sheet -------------------------------------
+    # Token usage per page. The system prompt is cached, and so is each request for the page after
+    # it (see history_window), so a book should pay for its shared prefix about once.
     translations = {}
-    history = []
-    for page, u_snap, u_data, a_snap in pages:
+    stats["usage"] = {}
+    stats["page_usage"] = {}
+    page_order = [p for p, _, _, _ in pages]
+    targets = {p: (u_snap, u_data, a_snap) for p, u_snap, u_data, a_snap in pages}
+    if incremental:
+        # New pages plus pages the changed sheet reaches, as runs of consecutive pages. A run
+        # starts from the stored translations before it, so it needs no seed.
+        stats["sheet_changes"] = sheet_changes(old_sheet, sheet)
+        touched = touched_pages(page_texts, stats["sheet_changes"])
+        selected = [p for p in page_order if p not in existing or p in touched]
+        stats["new_pages"] = [p for p in page_order if p not in existing]
+        stats["touched_pages"] = sorted(touched & set(existing))
+        slog(f"  incremental: {len(stats['new_pages'])} new page(s), "
+             f"{len(stats['sheet_changes'])} sheet change(s) reaching {stats['touched_pages']}")
+        for c in stats["sheet_changes"]:
+            slog(f"      {c['kind'][:-1]:7} {c['source'][:40]!r}: {c['before']} -> {c['after']}")
+        segments = []
+        for p in selected:
+            if segments and history_pages and page_order.index(p) == page_order.index(segments[-1][-1]) + 1:
+                segments[-1].append(p)
+            else:
+                segments.append([p])
+        translations = {p: t for p, t in existing.items() if p not in selected}
+        stats["kept"] = len(translations)
+    else:
+        segments = plan_segments(page_order, history_pages, segment_pages)
+    stats["segments"] = [[seg[0], seg[-1]] for seg in segments]
+
+    def prior_history(page):
+        """The stored translations before `page`, as history, for an incremental run."""
+        if not incremental or not history_pages:
+            return []
+        before = page_order[:page_order.index(page)]
+        return [(page_imgs[q][0], page_imgs[q][1], instruction, existing[q])
+                for q in before[-(history_pages + HISTORY_STRIDE):] if q in existing]
+    # What each page's doc holds from the last rebuild: (inputFingerprint, content), or None when
+    # the doc it is bound to does not answer this photo.
+    stored = {}
+    for p, u_snap, _, a_snap in pages:
+        prev = (a_snap.to_dict() or {}) if a_snap is not None else {}
+        if reuse and prev.get("replyTo") == u_snap.id and prev.get("inputFingerprint"):
+            stored[p] = (prev["inputFingerprint"], prev.get("content") or "")
+    stats["pages_reused"] = 0
+    # The first segment's first call writes the system-prompt cache entry; the others hold their
+    # first call until its response has begun, so they read that entry instead of each writing it.
+    primed, stop = threading.Event(), threading.Event()
+
+    def run_segment(seg, lead):
+        """Translate one segment in order; the `lead` segment primes the cache for the rest.
+        Returns [(page, text or None, error, usage, hist, fingerprint, reused)]."""
         try:
+            return translate_segment(seg, lead)
+        finally:
+            if lead:
+                primed.set()
+
+    def translate_segment(seg, lead):
+        history, out = prior_history(seg[0]), []
+        for page in seg:
+            if stop.is_set():
+                break
+            window = history_window(history, history_pages)
+            page_instruction = instruction
+            if not history and history_pages and page != page_order[0] and not incremental:
+                at = page_order.index(page)
+                page_instruction = seeded_instruction(
+                    instruction, page_texts, page_order[max(0, at - SEGMENT_OVERLAP):at])
+            page_usage = {}
             img, mime = page_imgs[page]
-            text = translate_page(model_id, system, instruction, img, mime,
-                                  history=tuple(history[-history_pages:]) if history_pages else ())
-        except Exception as e:  # noqa: BLE001
-            log(f"  [{chat_id[:10]}] p{page:3d} ERROR {type(e).__name__}: {str(e)[:90]}")
-            stats["errors"] += 1
-            continue
-        if not text:
-            log(f"  [{chat_id[:10]}] p{page:3d} EMPTY response — leaving the old text in place")
-            stats["errors"] += 1
-            continue
+            fp = page_fingerprint(model_id, system, page_instruction, img, window, version)
+            if page in stored and stored[page][0] == fp and stored[page][1]:
+                text = stored[page][1]
+                history.append((img, mime, page_instruction, text))
+                out.append((page, text, None, page_usage, len(window), fp, True))
+                continue
+            if not lead:
+                primed.wait()
+            try:
+                text = translate_page(model_id, system, page_instruction, img, mime,
+                                      history=window, usage=page_usage, on_start=primed.set,
+                                      cache_tail=(page != seg[-1]
+                                                  and next_reads_tail(len(history), history_pages)))
+            except Exception as e:  # noqa: BLE001
+                out.append((page, None, f"{type(e).__name__}: {str(e)[:90]}", page_usage,
+                            len(window), fp, False))
+                continue
+            if text:
+                history.append((img, mime, page_instruction, text))
+            out.append((page, text, None, page_usage, len(window), fp, False))
+        return out
+
+    if len(segments) > 1:
+        log(f"  [{chat_id[:10]}] pass 2 in {len(segments)} segment(s): "
+            + ", ".join(f"p{a}-{b}" for a, b in stats["segments"]))
+    ex = cf.ThreadPoolExecutor(max_workers=max(1, min(SEGMENT_WORKERS, len(segments))))
+    futs = [ex.submit(run_segment, seg, i == 0) for i, seg in enumerate(segments)]
+    # Each segment is written as soon as it finishes, so a run cut short keeps the pages it has.
+    finished = (r for f in cf.as_completed(futs) for r in f.result())
+    try:
+        for page, text, error, page_usage, hist, fp, reused in finished:
+            u_snap, u_data, a_snap = targets[page]
+            img, _ = page_imgs[page]
+            if reused:
+                translations[page] = text
+                stats["pages_reused"] += 1
+                if apply and (a_snap.to_dict() or {}).get("pageIndex") != page:
+                    a_snap.reference.update({"pageIndex": page})
+                continue
+            if page_usage:
+                stats["page_usage"][page] = page_usage
+                add_usage(stats["usage"], page_usage)
+            if error:
+                log(f"  [{chat_id[:10]}] p{page:3d} ERROR {error}")
+                stats["errors"] += 1
+                continue
+            if not text:
+                log(f"  [{chat_id[:10]}] p{page:3d} EMPTY response — leaving the old text in place")
+                stats["errors"] += 1
+                continue
 
-        # Full payload log: what went in (system + instruction + which photo) and what came out.
-        log(f"  [{chat_id[:10]}] p{page:3d} sys={len(system)}ch img={len(img)}B "
-            f"hist={len(history[-history_pages:]) if history_pages else 0}p "
-            f"msg={u_snap.id} -> {len(text)}ch  {text[:70]}".replace("\n", " "))
-        history.append((img, mime, instruction, text))
-        translations[page] = text
-
-        payload = {
-            "role": "assistant",
-            "content": text,
-            "replyTo": u_snap.id,
-            "pageIndex": page,
-            "model": model_id,
-            "rebuiltAt": firestore.SERVER_TIMESTAMP,
-            "isStreaming": False,
-            "userId": USER_ID,
-            # 1 ms after the photo: the reply sorts under its own page even for clients that still
-            # order purely by timestamp.
-            "timestamp": u_data["timestamp"] + datetime.timedelta(milliseconds=1),
-        }
-        if a_snap is not None:
-            prev_doc = a_snap.to_dict() or {}
-            # Keep the text as it was BEFORE the first rebuild. Re-running must not overwrite that
-            # with the previous rebuild's output and quietly lose the original.
-            if "contentBeforeRebuild" not in prev_doc:
-                payload["contentBeforeRebuild"] = prev_doc.get("content", "")
-            if apply:
-                a_snap.reference.update(payload)
-            stats["rebuilt"] += 1
-        else:
-            if apply:
-                chat_ref.collection("messages").add(payload)
-            stats["created"] += 1
+            # Full payload log: what went in (system + instruction + which photo) and what came out.
+            log(f"  [{chat_id[:10]}] p{page:3d} sys={len(system)}ch img={len(img)}B "
+                f"hist={hist}p cache_read={page_usage.get('cache_read_tokens', 0)} "
+                f"cache_write={page_usage.get('cache_creation_tokens', 0)} "
+                f"msg={u_snap.id} -> {len(text)}ch  {text[:70]}".replace("\n", " "))
+            translations[page] = text
+
+            payload = {
+                "role": "assistant",
+                "content": text,
+                "replyTo": u_snap.id,
+                "pageIndex": page,
+                "model": model_id,
+                "rebuiltAt": firestore.SERVER_TIMESTAMP,
+                "inputFingerprint": fp,
+                "isStreaming": False,
+                "userId": USER_ID,
+                # 1 ms after the photo: the reply sorts under its own page even for clients that still
+                # order purely by timestamp.
+                "timestamp": u_data["timestamp"] + datetime.timedelta(milliseconds=1),
+            }
+            if a_snap is not None:
+                prev_doc = a_snap.to_dict() or {}
+                # Keep the text as it was BEFORE the first rebuild. Re-running must not overwrite that
+                # with the previous rebuild's output and quietly lose the original.
+                if "contentBeforeRebuild" not in prev_doc:
+                    payload["contentBeforeRebuild"] = prev_doc.get("content", "")
+                if apply:
+                    a_snap.reference.update(payload)
+                stats["rebuilt"] += 1
+            else:
+                if apply:
+                    chat_ref.collection("messages").add(payload)
+                stats["created"] += 1
+    finally:
+        # A failed write must not leave the other segments running: stop each after its current
+        # page, and drop the ones not started.
+        stop.set()
+        ex.shutdown(wait=False, cancel_futures=True)
 
     # Surplus = an assistant doc with no page to answer. In 木偶奇遇记 that doc holds a REAL page
     # translation whose photo was never saved, so deleting it would destroy content that cannot be
@@ -706,17 +1101,34 @@ def process_chat(db, chat_id, templates, model_id, backup_dir, apply, img_cache,
     # Did the fixed wording actually hold? This is the check the first rebuild did not have, and
     # its absence is why a term drifting at page 19 shipped looking clean.
     stats["drift"] = check_refrains(sheet, translations, page_texts, log=lambda m: log(f"  [{chat_id[:10]}]{m}"))
+    # The same check across each seam between segments, which were translated without sight of
+    # each other: the pages of the two segments either side of it, on their own.
+    stats["boundary_drift"] = []
+    if history_pages and not incremental:
+        for before, after in zip(segments, segments[1:]):
+            span = before + after
+            problems = check_refrains(sheet, {p: translations[p] for p in span if p in translations},
+                                      {p: page_texts.get(p, "") for p in span},
+                                      log=lambda _m: None)
+            stats["boundary_drift"].append({"boundary": after[0], "pages": [before[0], after[-1]],
+                                            "drift": problems})
+            log(f"  [{chat_id[:10]}] segment boundary at p{after[0]} (p{before[0]}-{after[-1]}): "
+                + (f"{len(problems)} drift(s): " + "; ".join(
+                    f"{d['source'][:30]!r} missing on {d['missing_on']}" for d in problems)
+                   if problems else "held"))
 
     if apply:
         chat_ref.update({"systemPrompt": tpl["systemPrompt"],
                          "enableWebSearch": bool(tpl.get("enableWebSearch")),
                          "rebuiltAt": firestore.SERVER_TIMESTAMP, "rebuiltModel": model_id,
-                         "bookSheet": sheet or None})
+                         "bookSheet": sheet or None,
+                         "bookSheetFingerprint": sheet_fp if sheet else None})
         stats["verify"] = verify_chat(chat_ref)
         log(f"[{chat_id[:10]}] verify: {stats['verify']}")
 
     log(f"[{chat_id[:10]}] DONE rebuilt={stats['rebuilt']} created={stats['created']} "
-        f"deleted={stats['deleted']} errors={stats['errors']}")
+        f"deleted={stats['deleted']} reused={stats['pages_reused']} errors={stats['errors']} "
+        f"usage={json.dumps(stats['usage'])}")
     if stats["corrected_pages"]:
         log(f"[{chat_id[:10]}] pages followed by a conversation turn (usually a correction you "
             f"asked for — the fresh translation will not know about it): {stats['corrected_pages']}")
@@ -755,8 +1167,8 @@ def check_refrains(sheet, translations, page_texts, log=print):
             # 雨停咗喇 because the sheet fixed the noun 落雨, and 'sun' fires on 'sunshine'. The
             # failure this guards against is a multi-word running phrase changing halfway through
             # a book, which is always well over this length.
-            key = src.split("/")[0].split("[")[0].strip().lower()
-            if len(key) < 5:
+            key = source_key(src)
+            if len(key) < MIN_REFRAIN_KEY:
                 continue
             expected = sorted(p for p, t in page_texts.items() if key in (t or "").lower())
             missing = [p for p in expected if not present(fixed, translations.get(p, ""))]
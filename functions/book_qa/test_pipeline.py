@@ -0,0 +1,162 @@
+"""Incremental finalize picks the pages a sheet change reaches. Run: pytest functions/book_qa"""
+import copy
+import datetime
+import itertools
+
+import pytest
+
+import pipeline
+
+
+def test_short_latin_key_matches_whole_words_only():
+    pages = {1: "Tom ran to the river.", 2: "Tomorrow it rained.", 3: "Pip and TOM.", 4: "I know not."}
+    assert pipeline.touched_pages(pages, [{"source": "Tom"}]) == {1, 3}
+    assert pipeline.touched_pages(pages, [{"source": "no"}]) == set()
+
+
+def test_han_key_matches_anywhere():
+    pages = {1: "佢話落雨喇", 2: "天晴"}
+    assert pipeline.touched_pages(pages, [{"source": "落雨"}]) == {1}
+
+
+# --- a minimal in-memory Firestore, enough for process_chat ------------------------------------
+
+_ids = itertools.count(1)
+
+
+class _Ref:
+    def __init__(self, store, path):
+        self.store, self.path = store, path
+
+    @property
+    def id(self):
+        return self.path[-1]
+
+    def collection(self, name):
+        return _Coll(self.store, self.path + (name,))
+
+    def get(self):
+        return _Snap(self, self.store.get(self.path))
+
+    def set(self, payload):
+        self.store[self.path] = dict(payload)
+
+    def update(self, payload):
+        doc = self.store.setdefault(self.path, {})
+        for k, v in payload.items():
+            if "Sentinel" in type(v).__name__:
+                if "DELETE" in repr(v):
+                    doc.pop(k, None)
+                    continue
+                v = datetime.datetime.now(datetime.timezone.utc)
+            doc[k] = v
+
+    def delete(self):
+        self.store.pop(self.path, None)
+
+
+class _Snap:
+    def __init__(self, ref, data):
+        self.reference, self._data = ref, data
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class _Coll:
+    def __init__(self, store, path, order=None):
+        self.store, self.path, self.order = store, path, order
+
+    def document(self, doc_id):
+        return _Ref(self.store, self.path + (doc_id,))
+
+    def order_by(self, field):
+        return _Coll(self.store, self.path, field)
+
+    def select(self, fields):
+        return self
+
+    def add(self, payload):
+        ref = self.document(f"new{next(_ids)}")
+        ref.set({})
+        ref.update(payload)
+        return None, ref
+
+    def stream(self):
+        items = [(p, d) for p, d in self.store.items()
+                 if len(p) == len(self.path) + 1 and p[:-1] == self.path]
+        if self.order:
+            items.sort(key=lambda item: item[1].get(self.order))
+        return [_Snap(_Ref(self.store, p), d) for p, d in items]
+
+
+class _DB:
+    def __init__(self):
+        self.store = {}
+
+    def collection(self, name):
+        return _Coll(self.store, (name,))
+
+    def get_all(self, refs):
+        return [r.get() for r in refs]
+
+
+@pytest.fixture
+def book(monkeypatch):
+    db = _DB()
+    chat = db.collection("chats").document(pipeline.USER_ID).collection("conversations").document("c1")
+    chat.set({"title": "Book", "systemPrompt": "You translate English text into both"})
+    t0 = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    texts = {0: "Once upon a time.", 1: "Tom found a key.", 2: "Tomorrow came.",
+             3: "The river ran.", 4: "Tom went home.", 5: "The end of the day."}
+
+    def add_page(i):
+        chat.collection("messages").document(f"u{i:02d}").set({
+            "role": "user", "image": {"url": f"img{i}"},
+            "timestamp": t0 + datetime.timedelta(minutes=i)})
+
+    sheet = {"voice": "v", "terms": [{"source": "Tom", "yue": "阿湯"}], "refrains": []}
+    translated = []
+
+    def translate_page(model_id, system, instruction, image, mime, history=(), **kw):
+        translated.append(image.decode())
+        return f"譯 {image.decode()} {sheet['terms'][0]['yue']}"
+
+    monkeypatch.setattr(pipeline, "fetch_image", lambda url, cache: url.encode())
+    monkeypatch.setattr(pipeline, "ocr_page", lambda img, mime="image/jpeg": texts[int(img[3:])])
+    monkeypatch.setattr(pipeline, "build_book_sheet", lambda *a, **k: copy.deepcopy(sheet))
+    monkeypatch.setattr(pipeline, "vivid_palette", lambda **k: [])
+    monkeypatch.setattr(pipeline, "translate_page", translate_page)
+    return db, add_page, sheet, translated
+
+
+def test_short_name_change_retranslates_exactly_its_pages(book, tmp_path):
+    db, add_page, sheet, translated = book
+    template = {"systemPrompt": "S", "content": "C"}
+    templates = {pipeline.TEMPLATE_EN_TO_PU_YUE: template, pipeline.TEMPLATE_ZH_TO_YUE: template}
+
+    def run(**kw):
+        return pipeline.process_chat(db, "c1", templates, "claude-opus-5", tmp_path, True, {},
+                                     log=lambda m: None, **kw)
+
+    for i in range(5):
+        add_page(i)
+    run()
+    add_page(5)
+    sheet["terms"][0]["yue"] = "湯仔"
+    translated.clear()
+    st = run(incremental=True)
+
+    assert st["incremental"]
+    assert st["new_pages"] == [6]
+    assert st["touched_pages"] == [2, 5]           # "Tom", not "Tomorrow" on page 3
+    assert sorted(translated) == ["img1", "img4", "img5"]
+    assert st["kept"] == 3
@@ -0,0 +1,263 @@
+"""What goes into a chat request's context, measured before it is sent.
+
+Imported by main.py. Pure functions over the Anthropic content-block dicts main.py builds — no
+network, no Firebase, nothing at import time — so they can be exercised against a saved request.
+
+  estimate_block_tokens   a local token estimate for one text, image or PDF block. Deliberately
+                          rough (±20%); it ranks and budgets blocks, it does not bill them.
+                          Images are measured against main.py's IMAGE_LIMITS, passed in.
+  trim_to_budget          drop the oldest turns until the request fits an input-token budget.
+  plan_cache_breakpoints  where the four allowed cache_control breakpoints go, and whether each
+                          is written with the 5-minute or the 1-hour lifetime.
+"""
+import base64
+import io
+import re
+
+# The API accepts at most four cache_control breakpoints per request, and on a hit looks back at
+# most ~20 content blocks before each one for an earlier cache entry.
+MAX_BREAKPOINTS = 4
+LOOKBACK_BLOCKS = 20
+# The smallest cacheable prefix across the models this function uses. A breakpoint on a shorter
+# prefix is silently ignored by the API, so it would only waste one of the four slots.
+CACHE_MIN_TOKENS = 1024
+# Stable checkpoints every N messages. They sit at the same message index turn after turn, so once
+# written they still hit when the newest turns change — an edited and resent message, or a
+# regenerated reply — where a breakpoint that only ever tracks the tail would miss entirely.
+CHECKPOINT_EVERY = 8
+
+# Cache lifetimes. A 5-minute entry is written at 1.25x the input price, a 1-hour entry at 2x, and
+# either is read at 0.1x; every hit refreshes the lifetime for free. Book chats get a new photo
+# every few minutes, often just past five, so a 5-minute prefix expires between pages and the whole
+# image history is re-written at 1.25x. Whether the 1-hour premium pays depends on how likely the
+# next turn lands in the gap only it covers, which is read off the chat's recent cadence.
+TTL_SHORT_S = 5 * 60
+TTL_LONG_S = 60 * 60
+TTL_MARGIN_S = 30                # the gap is measured at the client, the cache lives at the API
+CADENCE_TURNS = 6                # recent user-turn gaps that make up the cadence
+WRITE_PREMIUM_LONG = 2.0 - 1.25  # extra cost per token of writing 1h instead of 5m
+MISS_SAVING = 1.25 - 0.1         # saved per token when a prefix is read rather than re-written
+
+# A PDF page is sent as both its extracted text and a page image.
+PDF_TOKENS_PER_PAGE = 2300
+
+CJK = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\U00020000-\U0003134f]")
+PDF_PAGE = re.compile(rb"/Type\s*/Page\b")
+
+
+def estimate_text_tokens(text):
+    """~1 token per CJK character, ~3.5 characters per token for everything else."""
+    if not text:
+        return 0
+    cjk = len(CJK.findall(text))
+    return cjk + round((len(text) - cjk) / 3.5)
+
+
+def estimate_image_tokens(b64, image_limits):
+    """Tokens for a base64 image, from the dimensions in its header.
+
+    `image_limits` is (max long edge, max pixels): an image past either is downscaled before it is
+    counted (tokens ~ pixels / 750), and one whose header cannot be read counts as a full-size one.
+    Only the first 96 KB of base64 is decoded — enough to reach a JPEG's SOF marker past a typical
+    EXIF block — so a 6 MB original costs no more to measure than a thumbnail.
+    """
+    max_long_edge, max_pixels = image_limits
+    try:
+        from PIL import Image
+        head = base64.b64decode(b64[:96 * 1024])
+        w, h = Image.open(io.BytesIO(head)).size
+    except Exception:
+        return max_pixels // 750
+    scale = min(1.0, max_long_edge / max(w, h), (max_pixels / (w * h)) ** 0.5)
+    return max(1, round(w * scale) * round(h * scale) // 750)
+
+
+def estimate_pdf_tokens(b64):
+    try:
+        pages = len(PDF_PAGE.findall(base64.b64decode(b64)))
+    except Exception:
+        pages = 0
+    return max(1, pages) * PDF_TOKENS_PER_PAGE
+
+
+def estimate_block_tokens(block, image_limits):
+    kind = block.get('type')
+    if kind == 'text':
+        return estimate_text_tokens(block.get('text'))
+    source = block.get('source') or {}
+    if kind == 'image' and source.get('type') == 'base64':
+        return estimate_image_tokens(source.get('data') or '', image_limits)
+    if kind == 'document' and source.get('type') == 'base64':
+        return estimate_pdf_tokens(source.get('data') or '')
+    return estimate_text_tokens(str(block))
+
+
+# Trimming drops whole turns from the front in strides of this many messages, so the trimmed
+# request stays byte-identical for several turns and its cached prefix keeps hitting. Even, so the
+# user/assistant alternation survives.
+TRIM_STRIDE_MESSAGES = 8
+# Always sent: the current turn and the exchange before it.
+TRIM_KEEP_LAST = 3
+TRIMMED_NOTE = "[Earlier turns of this conversation were omitted to fit the context budget.]"
+
+
+def message_tokens(message, image_limits):
+    return sum(estimate_block_tokens(b, image_limits) for b in message.get('content') or [])
+
+
+def trim_to_budget(system, messages, budget, image_limits):
+    """Fit `messages` under `budget` estimated input tokens by dropping the oldest turns.
+
+    The first message is kept when it is a user turn: in book chats it carries the instruction
+    every later page depends on. TRIMMED_NOTE is appended to it — a constant, so the kept prefix
+    is the same whichever stride the trim is on. Turns are dropped in TRIM_STRIDE_MESSAGES steps
+    from just after it, never touching the newest TRIM_KEEP_LAST.
+
+    Returns (messages, dropped, estimated_before, estimated_after). The input list is not
+    modified; the first message is copied before the note is added. When even the maximal trim
+    is over budget it is applied anyway and the caller is left to send it.
+    """
+    base = sum(estimate_block_tokens(b, image_limits) for b in system or [])
+    sizes = [message_tokens(m, image_limits) for m in messages]
+    before = base + sum(sizes)
+    if budget is None or before <= budget:
+        return messages, 0, before, before
+
+    start = 1 if messages and messages[0].get('role') == 'user' else 0
+    droppable = max(0, len(messages) - TRIM_KEEP_LAST - start)
+    droppable -= droppable % 2
+    note = estimate_text_tokens(TRIMMED_NOTE)
+    dropped, total = 0, before + note
+    while dropped < droppable and total > budget:
+        total -= sizes[start + dropped] + sizes[start + dropped + 1]
+        dropped += 2
+    dropped = min(droppable, -(-dropped // TRIM_STRIDE_MESSAGES) * TRIM_STRIDE_MESSAGES)
+    if not dropped:
+        return messages, 0, before, before
+
+    kept = messages[start + dropped:]
+    if start:
+        first = dict(messages[0])
+        first['content'] = list(first.get('content') or []) + [{'type': 'text', 'text': TRIMMED_NOTE}]
+        kept = [first] + kept
+    after = base + sum(message_tokens(m, image_limits) for m in kept)
+    return kept, dropped, before, after
+
+
+def _stable_tail(message):
+    """Index of the last block in `message` that will be byte-identical when it is history.
+
+    A photo-only turn is sent with the chat's opening instruction restated as its text, but is
+    stored with no text at all, so next turn the attachment is the last block that still matches.
+    """
+    content = message.get('content') or []
+    attachments = [j for j, b in enumerate(content) if b.get('type') in ('image', 'document')]
+    return attachments[-1] if attachments else len(content) - 1
+
+
+def long_gap_share(turn_times, now):
+    """Share of the chat's recent user-turn gaps that a 5-minute entry misses and a 1-hour
+    entry covers. `turn_times` are epoch seconds, oldest first; `now` is this turn. Returns
+    (share, gaps) — share is None when there is no history to judge from."""
+    times = sorted(t for t in turn_times if t) + [now]
+    gaps = [b - a for a, b in zip(times, times[1:])][-CADENCE_TURNS:]
+    if not gaps:
+        return None, []
+    hits = sum(1 for g in gaps if TTL_SHORT_S - TTL_MARGIN_S < g < TTL_LONG_S - TTL_MARGIN_S)
+    return hits / len(gaps), [round(g) for g in gaps]
+
+
+def plan_cache_breakpoints(system, messages, image_limits, pinned_message=None,
+                           min_tokens=CACHE_MIN_TOKENS, long_share=None):
+    """Place up to MAX_BREAKPOINTS cache_control markers on `system` + `messages`, in place.
+
+    The aim is the largest prefix read from cache, this turn and the next:
+      tail        the stable end of the current turn. Written now, read in full by the next turn.
+      previous    the previous turn's tail, which that request wrote. The tail's lookback already
+                  reaches it unless more than LOOKBACK_BLOCKS blocks separate the two.
+      pinned      `pinned_message` — the last message of a trimmed or elided prefix. Trimming
+                  moves forward in strides, so this prefix survives the next stride even though
+                  everything after it changes.
+      system      the system prompt, shared by every chat on the same template.
+      checkpoint  the newest message index that is a multiple of CHECKPOINT_EVERY.
+    Candidates are taken in that order; a candidate whose prefix is under `min_tokens` is skipped.
+
+    Lifetime per breakpoint: 1h when the expected saving on the next turn — the whole prefix read
+    instead of re-written, weighted by `long_share` (see long_gap_share) — beats the 1h premium on
+    the tokens this breakpoint newly writes. The API requires every 1h breakpoint to precede every
+    5m one, so a 1h decision promotes the breakpoints before it.
+
+    Returns the plan: [{'reason', 'message' (-1 = system), 'block', 'prefix_tokens', 'ttl'}], the
+    total estimated input tokens, and predicted_read_tokens — the prefix expected to be read from
+    cache, assuming the previous turn ran this same planner within the cache lifetime.
+    """
+    flat = []                       # (message index, block index, block), prompt order
+    for j, b in enumerate(system or []):
+        flat.append((-1, j, b))
+    for mi, m in enumerate(messages):
+        for j, b in enumerate(m.get('content') or []):
+            flat.append((mi, j, b))
+    cumulative, total = [], 0
+    for _, _, b in flat:
+        total += estimate_block_tokens(b, image_limits)
+        cumulative.append(total)
+    position = {(mi, j): k for k, (mi, j, _) in enumerate(flat)}
+
+    def tail_of(mi):
+        if mi is None or not (0 <= mi < len(messages)) or not messages[mi].get('content'):
+            return None
+        return position[(mi, _stable_tail(messages[mi]))]
+
+    user_turns = [mi for mi, m in enumerate(messages) if m.get('role') == 'user']
+    tail = tail_of(len(messages) - 1)
+    previous = tail_of(user_turns[-2]) if len(user_turns) > 1 else None
+    system_end = len(system) - 1 if system else None
+    checkpoint = None
+    for mi in range(len(messages) - 2, -1, -1):
+        if mi and mi % CHECKPOINT_EVERY == 0:
+            checkpoint = tail_of(mi)
+            break
+
+    candidates = [('tail', tail)]
+    if previous is not None and tail is not None and tail - previous > LOOKBACK_BLOCKS:
+        candidates.append(('previous', previous))
+    candidates += [('pinned', tail_of(pinned_message)), ('system', system_end),
+                   ('checkpoint', checkpoint)]
+
+    chosen = {}
+    for reason, k in candidates:
+        if len(chosen) == MAX_BREAKPOINTS:
+            break
+        if k is None or k in chosen or cumulative[k] < min_tokens:
+            continue
+        chosen[k] = reason
+
+    # What this request should read: the previous turn's tail if there was a previous turn,
+    # otherwise whatever the system prompt left in the cache for other chats on this template.
+    if previous is not None and cumulative[previous] >= min_tokens:
+        predicted = cumulative[previous]
+    elif system_end is not None and cumulative[system_end] >= min_tokens:
+        predicted = cumulative[system_end]
+    else:
+        predicted = 0
+
+    order = sorted(chosen)
+    ttls, covered = [], predicted
+    for k in order:
+        written = max(0, cumulative[k] - covered)
+        covered = max(covered, cumulative[k])
+        long = bool(long_share) and (long_share * MISS_SAVING * cumulative[k]
+                                     > WRITE_PREMIUM_LONG * written)
+        ttls.append('1h' if long else '5m')
+    if '1h' in ttls:
+        last_long = len(ttls) - 1 - ttls[::-1].index('1h')
+        ttls[:last_long] = ['1h'] * last_long
+
+    plan = []
+    for k, ttl in zip(order, ttls):
+        mi, j, block = flat[k]
+        block['cache_control'] = {'type': 'ephemeral', 'ttl': '1h'} if ttl == '1h' else {'type': 'ephemeral'}
+        plan.append({'reason': chosen[k], 'message': mi, 'block': j,
+                     'prefix_tokens': cumulative[k], 'ttl': ttl})
+    return {'breakpoints': plan, 'estimated_input_tokens': total,
+            'predicted_read_tokens': predicted}
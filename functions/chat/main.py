@@ -1,18 +1,22 @@
+import time
+_IMPORT_STARTED = time.perf_counter()
+
 import functions_framework
-from anthropic import AnthropicVertex
 from flask_cors import cross_origin
+import asyncio
 import json
+import hashlib
+import io
+import os
+import re
 import base64
-import httpx
-import firebase_admin
-from firebase_admin import credentials, storage
-from urllib.parse import urlparse, unquote
+import threading
+from collections import OrderedDict
+import concurrent.futures as cf
+from urllib.parse import urlparse, unquote, quote
 
-# Initialize Firebase Admin
-if not firebase_admin._apps:
-    firebase_admin.initialize_app()
+import context
 
-# Initialize the Anthropic client
 LOCATION = "global"
 PROJECT_ID = "wz-cloud-claude"
 # Winner of the book-page-translation task in WandLZhang/language-benchmarks (24 real page photos,
@@ -30,7 +34,273 @@ MODEL_RETRY = "claude-opus-4-8"   # second opinion when the default refuses or c
 MAX_TOKENS_OPUS = 128000
 MAX_TOKENS_SONNET = 64000
 
-client = AnthropicVertex(region=LOCATION, project_id=PROJECT_ID)
+# Clients are built on first use, not at import. `anthropic` alone is ~1.4s of import on a cold
+# instance and Firebase Admin adds its own; a cold start used to pay for both before the function
+# could even accept the request. Each client has its own lock, which makes concurrent first
+# requests build it once without one client's build (or a credential refresh) holding up another;
+# a built client is returned without taking the lock, so the event loop never waits on one.
+_clients = {}
+_client_locks = {name: threading.Lock()
+                 for name in ("ant", "bucket", "ant_async", "storage_http", "storage_creds")}
+
+# Offline runs (test_scripts/fake_vertex.py, load_test_chat.py) point the SDK at a local stand-in
+# with ANTHROPIC_VERTEX_BASE_URL, which it reads itself; a fixed VERTEX_ACCESS_TOKEN then stands in
+# for Google credentials. Unset in production, where the token comes from the service account.
+VERTEX_ACCESS_TOKEN = os.environ.get("VERTEX_ACCESS_TOKEN") or None
+
+
+def _client(name, build):
+    client = _clients.get(name)
+    if client is None:
+        with _client_locks[name]:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = build()
+    return client
+
+
+def _anthropic():
+    def build():
+        from anthropic import AnthropicVertex
+        return AnthropicVertex(region=LOCATION, project_id=PROJECT_ID,
+                               access_token=VERTEX_ACCESS_TOKEN)
+    return _client("ant", build)
+
+
+def _bucket():
+    def build():
+        import firebase_admin
+        from firebase_admin import storage
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app()
+        return storage.bucket(STORAGE_BUCKET)
+    return _client("bucket", build)
+
+
+def _anthropic_async():
+    def build():
+        from anthropic import AsyncAnthropicVertex
+        return AsyncAnthropicVertex(region=LOCATION, project_id=PROJECT_ID,
+                                    access_token=VERTEX_ACCESS_TOKEN)
+    return _client("ant_async", build)
+
+
+def _storage_http():
+    def build():
+        import httpx
+        return httpx.AsyncClient(timeout=60)
+    return _client("storage_http", build)
+
+
+def _storage_token():
+    """Access token for the Storage JSON API, refreshed when expired. Blocking: the async path
+    calls it through asyncio.to_thread. The refresh holds only the credentials' lock, so
+    concurrent callers wait for one refresh rather than each making their own."""
+    def build():
+        import google.auth
+        creds, _ = google.auth.default(
+            scopes=['https://www.googleapis.com/auth/devstorage.read_write'])
+        return creds
+    creds = _client("storage_creds", build)
+    with _client_locks["storage_creds"]:
+        if not creds.valid:
+            import google.auth.transport.requests
+            creds.refresh(google.auth.transport.requests.Request())
+        return creds.token
+
+
+def _vertex_ping():
+    """One cheap public call — count_tokens, no generation — so the access token is fetched and
+    a TLS connection is left in the client's pool for the first stream. Any response will do: an
+    HTTP error (a model without the endpoint, say) has done both, so it is not a failure."""
+    import anthropic
+    try:
+        _anthropic().with_options(max_retries=0).messages.count_tokens(
+            model=MODEL_FAST, messages=[{'role': 'user', 'content': 'warmup'}])
+    except anthropic.APIStatusError as e:
+        print(f"Warmup count_tokens answered {e.status_code}; the connection is up")
+
+
+def warmup():
+    """Build both clients, fetch their credentials and open a connection to each upstream, so
+    the first real request pays none of it. Each step is timed; a failed step is reported, not
+    raised — a warmup must never take the instance down."""
+    timings = {}
+
+    def step(name, fn):
+        started = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            print(f"Warmup step {name} failed: {e}")
+            timings[f"{name}_error"] = str(e)
+        timings[name] = round(time.perf_counter() - started, 3)
+
+    step('anthropic_client', _anthropic)
+    step('vertex_connect', _vertex_ping)
+    step('storage_client', _bucket)
+    step('storage_connect', lambda: _bucket().get_blob('warmup'))
+    return timings
+
+# Opt-in `thinking_chunk` events (request flag stream_thinking). At effort=max a turn can think for
+# a minute before the first answer token; streaming the summarized thinking makes that visible.
+# Deltas arrive every few milliseconds, so they are batched: the first goes out at once, later ones
+# at most every THINKING_CHUNK_INTERVAL_S — even if no further delta arrives to carry them — and
+# whatever is pending when the block ends.
+THINKING_CHUNK_INTERVAL_S = 0.25
+
+# Answer text is coalesced the same way. One SSE frame per delta meant one json.dumps and one
+# network write per few characters — thousands per long answer on both ends. A frame goes out once
+# SSE_FLUSH_INTERVAL_S has passed since the last one or SSE_FLUSH_CHARS (~2 KB) are pending, and
+# pending text is always flushed at the end of a block, before any other event, and whenever the
+# upstream goes SSE_FLUSH_INTERVAL_S without sending anything (see paced()).
+SSE_FLUSH_INTERVAL_S = float(os.getenv('SSE_FLUSH_INTERVAL_S', 0.03))
+SSE_FLUSH_CHARS = int(os.getenv('SSE_FLUSH_CHARS', 2048))
+
+# Every Storage attachment a request references is downloaded concurrently, up front, before the
+# message list is built. Serially, a 40-photo book chat made 40 Storage round trips before the
+# first token; with the pool it waits for roughly the slowest one. Bounded so a 70-page history
+# does not open 70 connections at once from a 1-CPU instance.
+ATTACHMENT_FETCH_WORKERS = 8
+attachment_pool = cf.ThreadPoolExecutor(max_workers=ATTACHMENT_FETCH_WORKERS,
+                                        thread_name_prefix='attachment')
+
+STORAGE_BUCKET = 'wz-cloud-claude.firebasestorage.app'
+
+
+class ByteLRU:
+    """Thread-safe LRU bounded by the total size of its values rather than their count.
+
+    Photos range from 200 KB to 8 MB, so a count bound says nothing about memory. Hit, miss and
+    eviction counters are kept so the bound can be sized against the instance memory limit.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()   # key -> (value, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            hit = self._items.get(key)
+            if hit is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return hit[0]
+
+    def put(self, key, value, size):
+        if size > self.max_bytes:
+            return   # would evict everything else and still not fit
+        with self._lock:
+            if key in self._items:
+                self._bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, old_size) = self._items.popitem(last=False)
+                self._bytes -= old_size
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._items), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class RecentSet:
+    """Thread-safe set that forgets its least recently used members past `max_entries`."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key not in self._items:
+                return False
+            self._items.move_to_end(key)
+            return True
+
+    def add(self, key):
+        with self._lock:
+            self._items[key] = None
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+# Cross-request attachment cache. A book chat re-sends every earlier page photo on every turn, so
+# without this each follow-up re-downloads and re-base64-encodes the same Storage objects. Keyed by
+# (object path, generation): an overwritten object gets a new generation and can never be served
+# stale. Holds the already-encoded payload, so a hit costs neither a download nor an encode. The
+# default leaves most of the 1 GiB instance for request building and the stream itself.
+ATTACHMENT_CACHE_MAX_BYTES = int(os.getenv('ATTACHMENT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+attachment_cache = ByteLRU(ATTACHMENT_CACHE_MAX_BYTES)
+
+# Request-time image normalisation. Phone photos arrive at 3-8 MB and 4000px on the long edge, and
+# the model downscales anything past its limit anyway (long edge 1568px, ~1.15 MP), so forwarding
+# the original only costs request bytes — a third more once base64-encoded — upload time to Vertex
+# and instance memory. Each source generation is transcoded once; the result is written next to the
+# photos under NORMALIZED_PREFIX (admin-only: storage.rules grant clients nothing there) and read
+# back on later turns and instances. The limits and quality are in the variant's path, so changing
+# any of them produces fresh variants rather than serving old ones.
+NORMALIZE_IMAGES = os.getenv('NORMALIZE_IMAGES', '1') != '0'
+IMAGE_MAX_LONG_EDGE = int(os.getenv('IMAGE_MAX_LONG_EDGE', 1568))
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', 1_150_000))
+# What the context estimates measure an image against (context.estimate_image_tokens).
+IMAGE_LIMITS = (IMAGE_MAX_LONG_EDGE, IMAGE_MAX_PIXELS)
+IMAGE_JPEG_QUALITY = int(os.getenv('IMAGE_JPEG_QUALITY', 85))
+# An image already inside the limits is still re-encoded past this size (a 1500px PNG screenshot
+# or a quality-100 JPEG), never below it — re-encoding a small JPEG only loses detail.
+IMAGE_REENCODE_MIN_BYTES = int(os.getenv('IMAGE_REENCODE_MIN_BYTES', 1024 * 1024))
+NORMALIZED_PREFIX = 'normalized'
+TRANSCODABLE_TYPES = {'image/jpeg', 'image/png', 'image/webp'}
+# A source normalize_image leaves as it is has no variant of its own. An empty object of this type
+# is stored at its variant path instead, so a later miss downloads the original without another
+# transcode attempt, and `normalized_originals` lets this instance skip even that lookup.
+ORIGINAL_MARKER_TYPE = 'application/x-normalized-original'
+normalized_originals = RecentSet(4096)
+
+# Let the cache planner write 1-hour breakpoints when the chat's cadence says they pay
+# (context.long_gap_share). Off means every breakpoint is the default 5-minute ephemeral.
+CACHE_TTL_1H = os.getenv('CACHE_TTL_1H', '1') != '0'
+
+# History image window. Page 70 of a book chat used to inline all 69 earlier photos, so request
+# size, input tokens and function memory grew without bound. Only the newest HISTORY_IMAGE_WINDOW
+# historical images are sent; older image turns keep their text and lose the photo. The book
+# pipeline measured its history arm over at most 5 prior pages, so 8 leaves headroom.
+#   policy 'placeholder'  the photo becomes a one-line note, the turn's own text is kept after it
+#   policy 'text'         the photo is dropped and the turn's own text stands alone (the note is
+#                         used only when the turn has no text, so it never becomes empty)
+# Elision advances HISTORY_IMAGE_STRIDE images at a time instead of one per turn: a window that
+# slid every turn would rewrite an early message each turn and invalidate the cached prefix behind
+# it, while a stride keeps the prefix byte-identical for STRIDE turns in a row.
+HISTORY_IMAGE_WINDOW = int(os.getenv('HISTORY_IMAGE_WINDOW', 8))     # -1 = send every image
+HISTORY_IMAGE_STRIDE = int(os.getenv('HISTORY_IMAGE_STRIDE', 4))
+HISTORY_IMAGE_POLICY = os.getenv('HISTORY_IMAGE_POLICY', 'placeholder')
+HISTORY_IMAGE_PLACEHOLDER = ("[An earlier photo was attached here. It is no longer re-sent; "
+                             "rely on the conversation that followed it.]")
+
+# Input-token budget. Long text chats (and PDFs, which the image window does not touch) used to
+# grow until Vertex rejected the request outright. The request is measured locally before it is
+# sent (context.estimate_block_tokens) and, if over, the oldest turns are dropped in strides (see
+# context.trim_to_budget). The first user turn is always kept. -1 = no budget.
+INPUT_TOKEN_BUDGET = int(os.getenv('INPUT_TOKEN_BUDGET', 150_000))
+
+# Single-flight for duplicate sends. A double tap, or the phone retrying a request its flaky
+# connection dropped, sends the same body again seconds later and used to start a second full
+# Opus generation. Requests from the same caller whose bodies hash the same (flight_key_of) share
+# one upstream stream on this instance: a duplicate replays the events buffered so far and follows
+# the rest (see Flight). A finished flight is kept
+# COALESCE_LINGER_S so a retry that lands just after 'done' still gets the answer. Send
+# coalesce=false to force a fresh generation.
+COALESCE = os.getenv('COALESCE', '1') == '1'
+COALESCE_LINGER_S = float(os.getenv('COALESCE_LINGER_S', 15))
 
 # System prompt for wrap_content mode — converts Chinese+phonetic text to
 # HTML wrappers (<span class="zh-yue"> for Cantonese, <ruby><rt> for Mandarin).
@@ -186,22 +456,479 @@ OUTPUT:
 <span class="zh-yue">你好</span>
 """
 
+# WRAP_PROMPT is ~1.9k tokens, over the cacheable minimum, and identical on every wrap call, so it
+# is sent as a cached system block: 0.1x input price on every call after the first in 5 minutes.
+WRAP_SYSTEM = [{'type': 'text', 'text': WRAP_PROMPT, 'cache_control': {'type': 'ephemeral'}}]
+# Batch form ('wrap_contents'): items per request, and concurrent model calls per request.
+WRAP_BATCH_MAX = int(os.getenv('WRAP_BATCH_MAX', 100))
+WRAP_BATCH_WORKERS = int(os.getenv('WRAP_BATCH_WORKERS', 8))
+
+# Rule engine for wrap_content (wrap_by_rules). Most of WRAP_PROMPT is mechanical — no Chinese at
+# all, a Chinese line over its jyutping line, a **vocab** (jyutping) bullet, an already-wrapped
+# line — and those are done locally. Anything that needs judgement (Mandarin alignment, kana,
+# Chinese mixed into English prose, a Chinese line with no romanization and no HK character)
+# still goes to the model. Off with WRAP_RULES=0 or per request with use_rules=false.
+WRAP_RULES = os.getenv('WRAP_RULES', '1') != '0'
+HAN = r"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\U00020000-\U0003134f"
+HAN_CHAR = re.compile(f"[{HAN}]")
+KANA = re.compile(r"[\u3040-\u30ff]")
+PINYIN_MARKS = re.compile(r"[āáǎàēéěèīíǐìōóǒòūúǔùǖǘǚǜ]")
+# Characters only written Cantonese uses. Not 係 or 唔: Mandarin has them too (關係, 唔 as an
+# interjection), so 我們的關係很好 would pass for Cantonese.
+HK_CHARS = set("嘅喺哋佢啲咗嚟嘢㗎咩嗰噉諗冇俾")
+# Characters of standard written Chinese that Cantonese writes differently (們/哋, 的/嘅, 很/好,
+# 是/係, 這/呢, 沒/冇). A line with any of them goes to the model even next to an HK character.
+MANDARIN_CHARS = set("們的很是這那麼沒")
+JYUTPING_SYLLABLE = re.compile(r"[a-z]+[1-6]", re.I)
+JYUTPING_LINE = re.compile(r"^\s*[a-z]+[1-6](?:[\s,.!?;:'，。！？、-]+[a-z]+[1-6])*[\s,.!?;:，。！？、]*$", re.I)
+UNTONED_LINE = re.compile(r"^\s*[a-z]+(?:[\s,.!?;:'-]+[a-z]+)*[\s,.!?;:]*$", re.I)
+# A line that is nothing but Chinese (plus punctuation and inner emphasis) after an optional
+# list / header / quote marker, which stays outside the span.
+CHINESE_LINE = re.compile(
+    rf"^(\s*(?:(?:[-*+]|\d+[.)]|#{{1,6}}|>)\s+)?)([{HAN}][{HAN}\s，。！？、；：「」『』（）《》…—·,.!?;:\"'“”‘’*]*?)(\s*)$")
+VOCAB_JYUTPING = re.compile(rf"\*\*([{HAN}]+)\*\* \(([a-z]+[1-6](?:\s+[a-z]+[1-6])*)\)", re.I)
+WRAPPED = re.compile(r'<span class="zh-yue">.*?</span>|<ruby>.*?</ruby>')
+
+# Model wrap results, content-addressed: sha256 of (WRAP_PROMPT_VERSION, model, input). The same
+# text is wrapped again by client retries, --force backfill re-runs and refrains shared across
+# chats. An in-process LRU sits in front of Storage objects under WRAP_CACHE_PREFIX (admin-only,
+# like NORMALIZED_PREFIX), so results survive instances and deploys. The version is derived from
+# the prompt text itself: editing WRAP_PROMPT retires every entry without a manual bump.
+WRAP_CACHE = os.getenv('WRAP_CACHE', '1') != '0'
+WRAP_CACHE_PREFIX = 'wrap-cache'
+WRAP_PROMPT_VERSION = hashlib.sha256(WRAP_PROMPT.encode()).hexdigest()[:12]
+wrap_cache = ByteLRU(int(os.getenv('WRAP_CACHE_MAX_BYTES', 32 * 1024 * 1024)))
+
+# Pipelined wrapping (stream_wrapped): paragraphs of a streaming answer are wrapped as soon as
+# they are complete, on this shared pool, so the wrapped message is ready about one paragraph
+# after the last token instead of a whole wrap_content round trip after 'done'.
+PARAGRAPH_BREAK = re.compile(r"\n{2,}")
+wrap_pool = cf.ThreadPoolExecutor(max_workers=WRAP_BATCH_WORKERS, thread_name_prefix='wrap')
+
+
+def normalize_image(content, media_type):
+    """Downscale `content` to the model's effective resolution and re-encode it.
+
+    Returns (bytes, media_type). Returns the input unchanged when it is already inside the limits
+    and small, or when re-encoding would not make it smaller.
+    """
+    from PIL import Image, ImageOps
+
+    img = Image.open(io.BytesIO(content))
+    w, h = img.size
+    scale = min(1.0, IMAGE_MAX_LONG_EDGE / max(w, h), (IMAGE_MAX_PIXELS / (w * h)) ** 0.5)
+    if scale >= 1.0 and len(content) <= IMAGE_REENCODE_MIN_BYTES:
+        return content, media_type
+
+    # Phone cameras store rotation in EXIF, which the re-encode drops — bake it into the pixels
+    # first or the model reads every portrait page sideways.
+    img = ImageOps.exif_transpose(img)
+    if scale < 1.0:
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                         Image.LANCZOS)
+
+    out = io.BytesIO()
+    has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+    if has_alpha:
+        img.save(out, format='PNG', optimize=True)
+        new_type = 'image/png'
+    else:
+        img.convert('RGB').save(out, format='JPEG', quality=IMAGE_JPEG_QUALITY, optimize=True)
+        new_type = 'image/jpeg'
+    if out.tell() >= len(content):
+        return content, media_type
+    return out.getvalue(), new_type
+
+
+def normalized_variant_path(file_path, generation):
+    return (f"{NORMALIZED_PREFIX}/{file_path}/{generation}"
+            f"-e{IMAGE_MAX_LONG_EDGE}-p{IMAGE_MAX_PIXELS}-q{IMAGE_JPEG_QUALITY}")
+
+
+def load_normalized_image(bucket, file_path, blob):
+    """(bytes, media_type) of the model-sized variant of `blob`, transcoded at most once per
+    source generation. Falls back to the original bytes if transcoding fails, and serves them
+    directly when the source is already model-sized (ORIGINAL_MARKER_TYPE)."""
+    variant_path = normalized_variant_path(file_path, blob.generation)
+    media_type = blob.content_type or 'image/jpeg'
+    if variant_path not in normalized_originals:
+        variant = bucket.get_blob(variant_path)
+        if variant is None:
+            original = blob.download_as_bytes(if_generation_match=blob.generation)
+            return transcode_and_store(bucket, file_path, variant_path, original, media_type)
+        if variant.content_type != ORIGINAL_MARKER_TYPE:
+            return variant.download_as_bytes(), variant.content_type or 'image/jpeg'
+        normalized_originals.add(variant_path)
+    return blob.download_as_bytes(if_generation_match=blob.generation), media_type
+
+
+def transcode_and_store(bucket, file_path, variant_path, original, media_type):
+    """normalize_image, then store the result at `variant_path` for later turns and instances."""
+    try:
+        content, new_type = normalize_image(original, media_type)
+    except Exception as e:
+        print(f"Image normalisation failed for {file_path}, forwarding original: {e}")
+        return original, media_type
+    if content is original:
+        normalized_originals.add(variant_path)
+        try:
+            bucket.blob(variant_path).upload_from_string(b'', content_type=ORIGINAL_MARKER_TYPE)
+        except Exception as e:
+            print(f"Could not store the already-normalized marker {variant_path}: {e}")
+        return original, media_type
+
+    print(f"  normalized {file_path}: {len(original)}B {media_type} -> {len(content)}B {new_type}")
+    try:
+        bucket.blob(variant_path).upload_from_string(content, content_type=new_type)
+    except Exception as e:
+        # Not fatal: this request still sends the small variant, the next miss transcodes again.
+        print(f"Could not store normalized variant {variant_path}: {e}")
+    return content, new_type
+
+
+def sse_event(payload):
+    """One Server-Sent Events frame."""
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+def server_timing(timing):
+    """Server-Timing header value for a {name: milliseconds} dict."""
+    return ', '.join(f"{name};dur={ms}" for name, ms in timing.items())
+
+
+def refusal_signalled(event):
+    """True for the message_delta that carries stop_reason='refusal'."""
+    return getattr(getattr(event, 'delta', None), 'stop_reason', None) == 'refusal'
+
+
+def slim_text_fields(payload, field):
+    """Replace payload[field] with its UTF-8 length and SHA-256, for text the client already has."""
+    raw = (payload.pop(field, None) or '').encode('utf-8')
+    payload[f'{field}_length'] = len(raw)
+    payload[f'{field}_sha256'] = hashlib.sha256(raw).hexdigest()
+
+
+def images_to_elide(total, window, stride=HISTORY_IMAGE_STRIDE):
+    """How many of the oldest `total` history images fall outside the window.
+
+    Rounded up to a whole number of strides, so between window-stride+1 and window images stay
+    inline and the elided prefix only changes once every `stride` new images.
+    """
+    if window is None or window < 0 or total <= window:
+        return 0
+    stride = max(1, min(stride, window)) if window else 1
+    return min(total, -(-(total - window) // stride) * stride)
+
+
+def wrap_by_rules(content):
+    """WRAP_PROMPT's unambiguous cases, applied locally. Returns the wrapped text, or None when
+    any line needs the model. Line by line:
+      no Han characters            unchanged (rule 7), unless it is the jyutping line under a
+                                   Cantonese line, which is dropped (rules 1 and Example 7)
+      already wrapped              unchanged, if no Han character is left outside the wrappers
+      **詞** (jyutping) vocab       the word wrapped, the parenthetical dropped (rule 4), when the
+                                   syllable count matches
+      Chinese-only line            wrapped whole in zh-yue when the next line is its jyutping
+                                   (syllable-for-character) or it has an HK-distinctive character
+                                   and no Mandarin-only one
+    """
+    if not HAN_CHAR.search(content):
+        return content
+    if PINYIN_MARKS.search(content) or KANA.search(content) or '```' in content:
+        return None
+
+    lines = content.split('\n')
+    out = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        nxt = lines[i + 1] if i + 1 < len(lines) else None
+        if not HAN_CHAR.search(line):
+            out.append(line)
+            i += 1
+            continue
+
+        hans = len(HAN_CHAR.findall(line))
+        follows = nxt is not None and JYUTPING_LINE.match(nxt)
+        if follows and len(JYUTPING_SYLLABLE.findall(nxt)) != hans:
+            return None
+
+        m = CHINESE_LINE.match(line)
+        if m and not m.group(2).startswith('*') and not m.group(2).endswith('*'):
+            if not follows:
+                if nxt is not None and UNTONED_LINE.match(nxt):
+                    return None     # romanization without tone digits: leave it to the model
+                if not HK_CHARS.intersection(line) or MANDARIN_CHARS.intersection(line):
+                    return None     # Cantonese or Mandarin can't be told apart locally
+            out.append(f'{m.group(1)}<span class="zh-yue">{m.group(2)}</span>{m.group(3)}')
+            i += 2 if follows else 1
+            continue
+
+        def vocab(v):
+            if len(JYUTPING_SYLLABLE.findall(v.group(2))) != len(v.group(1)):
+                return v.group(0)
+            return f'**<span class="zh-yue">{v.group(1)}</span>**'
+        line = VOCAB_JYUTPING.sub(vocab, line)
+        if HAN_CHAR.search(WRAPPED.sub('', line)):
+            return None
+        out.append(line)
+        i += 2 if follows else 1
+    return '\n'.join(out)
+
+
+def wrap_cache_path(content, model):
+    key = hashlib.sha256(f"{WRAP_PROMPT_VERSION}\0{model}\0{content}".encode()).hexdigest()
+    return f"{WRAP_CACHE_PREFIX}/{WRAP_PROMPT_VERSION}/{key}"
+
+
+def wrap_cache_get(content, model):
+    path = wrap_cache_path(content, model)
+    wrapped = wrap_cache.get(path)
+    if wrapped is not None:
+        return wrapped
+    try:
+        blob = _bucket().get_blob(path)
+        if blob is None:
+            return None
+        wrapped = blob.download_as_bytes().decode('utf-8')
+    except Exception as e:
+        print(f"wrap cache read failed for {path}: {e}")
+        return None
+    wrap_cache.put(path, wrapped, len(wrapped.encode()))
+    return wrapped
+
+
+def wrap_cache_put(content, model, wrapped):
+    path = wrap_cache_path(content, model)
+    wrap_cache.put(path, wrapped, len(wrapped.encode()))
+    try:
+        _bucket().blob(path).upload_from_string(
+            wrapped.encode('utf-8'), content_type='text/plain; charset=utf-8')
+    except Exception as e:
+        print(f"wrap cache write failed for {path}: {e}")
+
+
+def wrap_text(content, model, use_rules=WRAP_RULES, use_cache=WRAP_CACHE):
+    """One wrap_content call. Returns (wrapped, usage, path): path 'rules' when wrap_by_rules
+    settled it locally, 'cache' for an earlier model result (both with usage None), 'model'
+    otherwise. Empty input comes back as-is, free."""
+    if not isinstance(content, str) or not content.strip():
+        return content or '', None, 'rules'
+    if use_rules:
+        wrapped = wrap_by_rules(content)
+        if wrapped is not None:
+            return wrapped, None, 'rules'
+    if use_cache:
+        wrapped = wrap_cache_get(content, model)
+        if wrapped is not None:
+            return wrapped, None, 'cache'
+    resp = _anthropic().messages.create(
+        model=model,
+        max_tokens=MAX_TOKENS_SONNET,
+        system=WRAP_SYSTEM,
+        messages=[{"role": "user", "content": content}],
+    )
+    wrapped = "".join(
+        b.text for b in resp.content if getattr(b, "type", None) == "text"
+    )
+    usage = {
+        'input_tokens': resp.usage.input_tokens,
+        'output_tokens': resp.usage.output_tokens,
+        'cache_read_tokens': getattr(resp.usage, 'cache_read_input_tokens', 0) or 0,
+        'cache_creation_tokens': getattr(resp.usage, 'cache_creation_input_tokens', 0) or 0,
+    }
+    if use_cache and resp.stop_reason == 'end_turn':
+        wrap_cache_put(content, model, wrapped)
+    return wrapped, usage, 'model'
+
+
+def wrap_batch(contents, model, use_rules=WRAP_RULES, use_cache=WRAP_CACHE):
+    """Wrap many contents. The first non-empty item runs alone so that it writes the WRAP_PROMPT
+    cache entry; the rest then fan out over WRAP_BATCH_WORKERS threads and read it. (Started all
+    at once, each would miss and write the same entry.) Items the rule engine settles never
+    reach the pool; result-cache lookups run inside it. Returns per-item results in input order, each
+    {'wrapped', 'usage', 'path'} or {'error'}, plus the summed usage."""
+    def one(content):
+        try:
+            wrapped, usage, path = wrap_text(content, model, use_rules=False, use_cache=use_cache)
+            return {'wrapped': wrapped, 'usage': usage, 'path': path}
+        except Exception as e:
+            print(f"wrap_batch item failed: {e}")
+            return {'error': str(e)}
+
+    results = [None] * len(contents)
+    pending = []
+    for i, content in enumerate(contents):
+        if not isinstance(content, str) or not content.strip():
+            results[i] = {'wrapped': content or '', 'usage': None, 'path': 'rules'}
+            continue
+        wrapped = wrap_by_rules(content) if use_rules else None
+        if wrapped is not None:
+            results[i] = {'wrapped': wrapped, 'usage': None, 'path': 'rules'}
+        else:
+            pending.append(i)
+    if pending:
+        first = pending.pop(0)
+        results[first] = one(contents[first])
+    with cf.ThreadPoolExecutor(max_workers=WRAP_BATCH_WORKERS) as pool:
+        for i, result in zip(pending, pool.map(one, [contents[i] for i in pending])):
+            results[i] = result
+
+    totals = {'input_tokens': 0, 'output_tokens': 0, 'cache_read_tokens': 0, 'cache_creation_tokens': 0}
+    for r in results:
+        for k, v in (r.get('usage') or {}).items():
+            totals[k] += v
+    return results, totals
+
+
+class ParagraphWrapper:
+    """Wraps one streamed attempt paragraph by paragraph, in the background.
+
+    feed() takes text deltas and submits each completed paragraph — text up to a blank line that
+    is not inside a code fence — to wrap_pool. ready() yields the 'wrapped_chunk' events that are
+    done, strictly in paragraph order, without blocking; drain(), an async generator, submits the
+    tail and yields the rest as they finish. Concatenating wrapped + sep over the events in index
+    order gives the wrapped message.
+    """
+
+    def __init__(self, model, attempt=0):
+        self.model = model
+        self.attempt = attempt
+        self.buffer = ''
+        self.futures = []       # (future, paragraph, sep), paragraph order
+        self.emitted = 0
+        self.paths = {}
+
+    def _submit(self, paragraph, sep):
+        self.futures.append((wrap_pool.submit(wrap_text, paragraph, self.model), paragraph, sep))
+
+    def feed(self, text):
+        self.buffer += text
+        start = 0
+        for m in PARAGRAPH_BREAK.finditer(self.buffer):
+            if m.end() == len(self.buffer):
+                break           # the run of newlines may not be over yet
+            paragraph = self.buffer[start:m.start()]
+            if paragraph.count('```') % 2:
+                continue        # inside a code fence: keep the block in one piece
+            self._submit(paragraph, m.group(0))
+            start = m.end()
+        self.buffer = self.buffer[start:]
+
+    def _event(self, future, paragraph, sep):
+        index = self.emitted
+        self.emitted += 1
+        try:
+            wrapped, _, path = future.result()
+        except Exception as e:
+            print(f"Paragraph {index} wrap failed, sending it unwrapped: {e}")
+            wrapped, path = paragraph, 'error'
+        self.paths[path] = self.paths.get(path, 0) + 1
+        return sse_event({'type': 'wrapped_chunk', 'index': index, 'attempt': self.attempt,
+                          'wrapped': wrapped, 'sep': sep, 'path': path})
+
+    def ready(self):
+        while self.emitted < len(self.futures) and self.futures[self.emitted][0].done():
+            yield self._event(*self.futures[self.emitted])
+
+    async def drain(self):
+        if self.buffer:
+            self._submit(self.buffer, '')
+            self.buffer = ''
+        while self.emitted < len(self.futures):
+            future = self.futures[self.emitted][0]
+            await asyncio.wait([asyncio.wrap_future(future)])
+            yield self._event(*self.futures[self.emitted])
+
+    def cancel(self):
+        for future, _, _ in self.futures[self.emitted:]:
+            future.cancel()
+
+    def summary(self):
+        return {'paragraphs': self.emitted, 'paths': self.paths}
+
+
+def parse_data_url(url, fallback_media_type):
+    """(base64_data, media_type) of a data: URL."""
+    b64 = url.split(',', 1)[1]
+    mime_part = url.split(',', 1)[0]
+    mime = mime_part.split(';')[0].split(':', 1)[1] if ':' in mime_part else fallback_media_type
+    return b64, mime
+
+
+def storage_path_of(url):
+    """Object path inside STORAGE_BUCKET of a Firebase Storage download URL, or None."""
+    parsed_url = urlparse(url)
+    if 'firebasestorage.googleapis.com' in parsed_url.netloc:
+        path_parts = parsed_url.path.split('/o/')
+        if len(path_parts) > 1:
+            return unquote(path_parts[1].split('?')[0])
+    return None
+
+
+def int_option(request_json, key, default, minimum=-1):
+    """An integer request option: `default` when it is missing or not a number, and never below
+    `minimum` (-1 is the "no limit" value of every option read this way)."""
+    try:
+        value = int(request_json.get(key, default))
+    except (TypeError, ValueError):
+        print(f"Ignoring {key}={request_json.get(key)!r}: not an integer")
+        return default
+    return max(minimum, value)
+
+
+def elided_history_images(messages, window):
+    """Indexes of the historical image turns that fall outside the history image window."""
+    historical = [i for i, msg in enumerate(messages[:-1])
+                  if msg.get('image') and msg['image'].get('url')]
+    return set(historical[:images_to_elide(len(historical), window)])
+
+
+def attachment_urls(request_json, elided):
+    """Every attachment URL a chat request will send, as (url, fallback media type), in the
+    order they are needed: current turn first, then history minus the `elided` image turns."""
+    urls = []
+    image_data = request_json.get('image')
+    document_data = request_json.get('document')
+    if image_data and 'url' in image_data:
+        urls.append((image_data['url'], image_data.get('type', 'image/jpeg')))
+    if document_data and 'url' in document_data:
+        urls.append((document_data['url'], 'application/pdf'))
+    for i, msg in enumerate(request_json.get('messages', [])[:-1]):
+        if msg.get('image') and msg['image'].get('url') and i not in elided:
+            urls.append((msg['image']['url'], msg['image'].get('type', 'image/jpeg')))
+        if msg.get('document') and msg['document'].get('url'):
+            urls.append((msg['document']['url'], 'application/pdf'))
+    return urls
+
 
 def download_file_from_storage(url):
-    """Download file (image or PDF) from Firebase Storage using Admin SDK."""
+    """Download file (image or PDF) from Firebase Storage using Admin SDK.
+
+    Served from `attachment_cache` when the object's current generation is already held; a miss
+    costs one metadata read on top of the download.
+    """
     try:
-        parsed_url = urlparse(url)
-
-        if 'firebasestorage.googleapis.com' in parsed_url.netloc:
-            path_parts = parsed_url.path.split('/o/')
-            if len(path_parts) > 1:
-                file_path = unquote(path_parts[1].split('?')[0])
-                bucket = storage.bucket('wz-cloud-claude.firebasestorage.app')
-                blob = bucket.blob(file_path)
-                content = blob.download_as_bytes()
-                content_type = blob.content_type or 'image/jpeg'
-                base64_data = base64.b64encode(content).decode('utf-8')
-                return base64_data, content_type
+        file_path = storage_path_of(url)
+        if file_path is not None:
+            bucket = _bucket()
+            blob = bucket.get_blob(file_path)
+            if blob is None:
+                raise ValueError(f"Storage object not found: {file_path}")
+            key = (file_path, blob.generation)
+            hit = attachment_cache.get(key)
+            if hit is not None:
+                return hit
+            content_type = blob.content_type or 'image/jpeg'
+            if NORMALIZE_IMAGES and content_type in TRANSCODABLE_TYPES:
+                content, content_type = load_normalized_image(bucket, file_path, blob)
+            else:
+                # Pin the download to the generation just read, so the cache key always
+                # describes the bytes stored under it.
+                content = blob.download_as_bytes(if_generation_match=blob.generation)
+            base64_data = base64.b64encode(content).decode('utf-8')
+            attachment_cache.put(key, (base64_data, content_type), len(base64_data))
+            return base64_data, content_type
 
         raise ValueError("Invalid Firebase Storage URL")
 
@@ -209,6 +936,406 @@ def download_file_from_storage(url):
         print(f"Error downloading file from Firebase Storage: {str(e)}")
         raise
 
+
+STORAGE_API = 'https://storage.googleapis.com/storage/v1/b'
+
+
+async def storage_get(path, media=False, generation=None):
+    """An object's metadata, or with `media` its bytes, through the Storage JSON API on the
+    event loop. None when the object does not exist."""
+    token = await asyncio.to_thread(_storage_token)
+    params = {'alt': 'media'} if media else {'fields': 'generation,contentType'}
+    if generation is not None:
+        params['ifGenerationMatch'] = str(generation)
+    resp = await _storage_http().get(f"{STORAGE_API}/{STORAGE_BUCKET}/o/{quote(path, safe='')}",
+                                     params=params, headers={'Authorization': f'Bearer {token}'})
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.content if media else resp.json()
+
+
+async def download_file_from_storage_async(url):
+    """download_file_from_storage for the ASGI handler: the same cache keys and normalized
+    variants, with every Storage read awaited instead of holding a thread. Only a transcode
+    (CPU, plus the variant upload) goes to a worker thread."""
+    file_path = storage_path_of(url)
+    if file_path is None:
+        raise ValueError("Invalid Firebase Storage URL")
+    meta = await storage_get(file_path)
+    if meta is None:
+        raise ValueError(f"Storage object not found: {file_path}")
+    generation = int(meta['generation'])
+    key = (file_path, generation)
+    hit = attachment_cache.get(key)
+    if hit is not None:
+        return hit
+    content_type = meta.get('contentType') or 'image/jpeg'
+    variant_path = normalized_variant_path(file_path, generation)
+    if (NORMALIZE_IMAGES and content_type in TRANSCODABLE_TYPES
+            and variant_path not in normalized_originals):
+        variant = await storage_get(variant_path)
+        if variant is None:
+            original = await storage_get(file_path, media=True, generation=generation)
+            content, content_type = await asyncio.to_thread(
+                transcode_and_store, _bucket(), file_path, variant_path, original, content_type)
+        elif variant.get('contentType') != ORIGINAL_MARKER_TYPE:
+            content = await storage_get(variant_path, media=True)
+            content_type = variant.get('contentType') or 'image/jpeg'
+        else:
+            normalized_originals.add(variant_path)
+            content = await storage_get(file_path, media=True, generation=generation)
+    else:
+        content = await storage_get(file_path, media=True, generation=generation)
+    base64_data = base64.b64encode(content).decode('utf-8')
+    attachment_cache.put(key, (base64_data, content_type), len(base64_data))
+    return base64_data, content_type
+
+# On-demand profiling. A profiled request runs under a sampling profiler (pyinstrument; cProfile
+# when it is not installed) plus tracemalloc, and writes <id>.html/.txt and <id>-alloc.txt to
+# PROFILE_DEST — a local directory, or 'storage:<prefix>' for the function's bucket. A request is
+# profiled when PROFILE_REQUESTS=1, or when it sends X-Profile-Token equal to PROFILE_TOKEN (unset
+# = the header is ignored). Off, the cost is one flag test and one header lookup per request.
+# tracemalloc is process-wide: two profiled requests at once see each other's allocations.
+PROFILE_REQUESTS = os.getenv('PROFILE_REQUESTS', '0') == '1'
+PROFILE_TOKEN = os.getenv('PROFILE_TOKEN')
+PROFILE_DEST = os.getenv('PROFILE_DEST', '/tmp/chat-profiles')
+PROFILE_INTERVAL_S = 0.001
+PROFILE_ALLOC_TOP = 40
+
+
+class RequestProfile:
+    """CPU and allocation profile of one request, from start() to stop()."""
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.profiler = None
+        self.owns_tracemalloc = False
+
+    def start(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self.owns_tracemalloc = True
+        try:
+            from pyinstrument import Profiler
+            self.profiler = Profiler(interval=PROFILE_INTERVAL_S)
+        except ImportError:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+
+    def stop(self):
+        """Stop both profilers and write the reports. Never raises: a broken profile must not
+        break the response it was measuring."""
+        import tracemalloc
+        try:
+            pyinstrument = hasattr(self.profiler, 'output_html')
+            if pyinstrument:
+                self.profiler.stop()
+            else:
+                self.profiler.disable()
+
+            # Snapshot allocations before rendering, so the report does not profile itself.
+            current, peak = tracemalloc.get_traced_memory()
+            lines = [f"traced current={current} peak={peak}"]
+            lines += [str(stat) for stat in
+                      tracemalloc.take_snapshot().statistics('lineno')[:PROFILE_ALLOC_TOP]]
+            if self.owns_tracemalloc:
+                tracemalloc.stop()
+
+            if pyinstrument:
+                cpu_name, cpu = f"{self.request_id}.html", self.profiler.output_html()
+            else:
+                import pstats
+                out = io.StringIO()
+                pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(80)
+                cpu_name, cpu = f"{self.request_id}.txt", out.getvalue()
+            written = [self._write(cpu_name, cpu),
+                       self._write(f"{self.request_id}-alloc.txt", '\n'.join(lines))]
+            print(f"Profile written: {written}")
+        except Exception as e:
+            print(f"Profile for {self.request_id} failed: {e}")
+
+    def _write(self, name, text):
+        if PROFILE_DEST.startswith('storage:'):
+            path = f"{PROFILE_DEST[len('storage:'):].strip('/')}/{name}"
+            _bucket().blob(path).upload_from_string(text.encode('utf-8'), content_type='text/plain')
+            return f"gs://{STORAGE_BUCKET}/{path}"
+        os.makedirs(PROFILE_DEST, exist_ok=True)
+        path = os.path.join(PROFILE_DEST, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+
+class SyncStream:
+    """The sync Vertex stream behind the async interface generate() is written against, for the
+    Flask path. Every await blocks the thread driving the stream — the request's own, which WSGI
+    holds anyway, or a coalesced flight's producer."""
+
+    def __init__(self, opts):
+        self.manager = _anthropic().messages.stream(**opts)
+        self.stream = None
+
+    async def __aenter__(self):
+        self.stream = self.manager.__enter__()
+        return self
+
+    async def __aexit__(self, *exc):
+        return self.manager.__exit__(*exc)
+
+    async def __aiter__(self):
+        # Each read waits on a worker thread rather than on the loop, so paced() can still flush
+        # pending output while the upstream is quiet.
+        events = iter(self.stream)
+        while True:
+            event = await asyncio.to_thread(next, events, None)
+            if event is None:
+                return
+            yield event
+
+    @property
+    def current_message_snapshot(self):
+        return self.stream.current_message_snapshot
+
+
+def open_stream(transport, opts):
+    """An async-context-managed Vertex message stream for `transport` ('wsgi' or 'asgi')."""
+    if transport == 'asgi':
+        return _anthropic_async().messages.stream(**opts)
+    return SyncStream(opts)
+
+
+async def paced(stream, interval):
+    """The events of `stream`, with a None in between whenever `interval` seconds pass without
+    one, so the caller can flush output it is holding back instead of waiting for the next event."""
+    events = stream.__aiter__()
+    upcoming = None
+    try:
+        while True:
+            if upcoming is None:
+                upcoming = asyncio.ensure_future(events.__anext__())
+            try:
+                event = await asyncio.wait_for(asyncio.shield(upcoming), interval)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            except StopAsyncIteration:
+                upcoming = None
+                return
+            upcoming = None
+            yield event
+    finally:
+        if upcoming is not None:
+            upcoming.cancel()
+
+
+_thread_loops = threading.local()
+
+
+def drive(events):
+    """Iterate the async generator `events` from sync code — the Flask response body — on the
+    worker thread's own event loop, made on its first request and reused by every later one."""
+    loop = getattr(_thread_loops, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _thread_loops.loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(events.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(events.aclose())
+
+
+class Flight:
+    """One upstream chat stream shared by every identical request on this instance.
+
+    The stream is produced independently of any one caller — on a thread for the Flask path, as
+    a task on the server's loop for ASGI — so the request that started it can drop its connection
+    (the usual reason a duplicate arrives) without cutting off the one that replaced it. Each
+    caller follows the buffered SSE events from the start. When the last follower leaves before
+    the stream is done, the producer stops at its next event and the upstream stream is closed,
+    as it would have been for a single abandoned request. Only a flight that ended in 'done' is
+    kept for late duplicates; an abandoned or failed one is forgotten, so a retry starts afresh.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.events = []
+        self.finished_at = None
+        self.followers = 1            # the caller that creates the flight
+        self.lock = threading.Lock()
+        self.wakers = set()
+        self.task = None              # the ASGI producer, kept referenced while it runs
+
+    def start(self, events, transport, loop=None):
+        if transport == 'asgi':
+            # Started from chat_response's worker thread; the producer runs on the server's `loop`.
+            self.task = asyncio.run_coroutine_threadsafe(self.pump(events), loop)
+        else:
+            threading.Thread(target=asyncio.run, args=(self.pump(events),), daemon=True,
+                             name=f"flight-{self.key[:8]}").start()
+
+    async def pump(self, events):
+        try:
+            async for event in events:
+                self.publish(event)
+                if not self.followers:
+                    print(f"Flight {self.key[:12]}: every caller left — closing the upstream stream")
+                    break
+        finally:
+            await events.aclose()
+            self.finish()
+
+    def fail(self, error):
+        """End a flight whose leader failed before its stream started: every follower gets the
+        error event the stream itself would have sent."""
+        self.publish(sse_event({'type': 'error', 'error': error}))
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.finished_at = time.monotonic()
+            wakers = list(self.wakers)
+            answered = bool(self.events) and self.events[-1].startswith(DONE_EVENT_PREFIX)
+        if not answered:
+            with flights_lock:
+                if flights.get(self.key) is self:
+                    del flights[self.key]
+        for wake in wakers:
+            wake()
+
+    def publish(self, event):
+        with self.lock:
+            self.events.append(event)
+            wakers = list(self.wakers)
+        for wake in wakers:
+            wake()
+
+    async def follow(self):
+        """The buffered events from the start, then each new one as it is published."""
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+
+        def wake():
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:      # this follower's loop is already closed
+                pass
+
+        with self.lock:
+            self.wakers.add(wake)
+        sent = 0
+        try:
+            while True:
+                with self.lock:
+                    ready.clear()
+                    batch = self.events[sent:]
+                    finished = self.finished_at is not None
+                for event in batch:
+                    yield event
+                sent += len(batch)
+                if finished:
+                    return
+                if not batch:
+                    await ready.wait()
+        finally:
+            with self.lock:
+                self.wakers.discard(wake)
+                self.followers -= 1
+
+
+flights = {}
+flights_lock = threading.Lock()
+DONE_EVENT_PREFIX = sse_event({'type': 'done'})[:-3]   # 'data: {"type": "done"'
+
+
+def caller_identity(headers, remote_addr=None):
+    """Who sent a request, so single-flight never hands one caller's stream to another: the
+    digest of its Authorization header when it has one, else the client address (the first
+    X-Forwarded-For hop, as the Cloud Run front end reports it)."""
+    auth = headers.get('Authorization')
+    if auth:
+        return 'auth:' + hashlib.sha256(auth.encode('utf-8')).hexdigest()[:16]
+    forwarded = (headers.get('X-Forwarded-For') or '').split(',')[0].strip()
+    return 'ip:' + (forwarded or remote_addr or '')
+
+
+def flight_key_of(request_json, caller):
+    """The single-flight key: the caller and the request body as it arrived. Attachments are
+    Storage URLs there, not the downloaded base64 message_options ends up holding, so the key costs
+    a few KB of hashing whatever the request attaches; only inline data (a data: URL or an
+    image's 'data') is hashed whole. On one instance everything sent upstream and every output
+    option follows from the body, and the app's user_id is part of it."""
+    def compact(value):
+        if isinstance(value, dict):
+            return {k: compact(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [compact(v) for v in value]
+        if isinstance(value, str) and len(value) > 4096:
+            return 'sha256:' + hashlib.sha256(value.encode('utf-8')).hexdigest()
+        return value
+    body = {k: v for k, v in request_json.items() if k != 'coalesce'}
+    return hashlib.sha256(json.dumps([caller, compact(body)], sort_keys=True,
+                                     default=str).encode('utf-8')).hexdigest()
+
+
+def join_flight(key):
+    """The in-flight (or just finished) Flight for `key` and False, or a new one to start and
+    True. Finished flights past COALESCE_LINGER_S are dropped on the way."""
+    now = time.monotonic()
+    with flights_lock:
+        for stale in [k for k, f in flights.items()
+                      if f.finished_at is not None and now - f.finished_at > COALESCE_LINGER_S]:
+            del flights[stale]
+        flight = flights.get(key)
+        if flight is not None:
+            with flight.lock:
+                # Every caller already left an unfinished flight: its producer is stopping.
+                if flight.followers or flight.finished_at is not None:
+                    flight.followers += 1
+                    return flight, False
+        flight = flights[key] = Flight(key)
+        return flight, True
+
+
+def claim_flight(request_json, caller, coalesce=True):
+    """join_flight for a chat request body, or (None, True) when it stays off the single-flight
+    map. Called before any attachment is fetched, so a duplicate costs one hash of its body."""
+    if not (coalesce and COALESCE and request_json.get('coalesce', True)):
+        return None, True
+    return join_flight(flight_key_of(request_json, caller))
+
+
+def sse_response(events, transport, headers):
+    """The streaming response for `events`: Starlette for 'asgi', Flask (via drive) otherwise."""
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', **headers}
+    if transport == 'asgi':
+        from starlette.responses import StreamingResponse
+        return StreamingResponse(events, media_type='text/event-stream',
+                                 headers={**headers, 'Access-Control-Allow-Origin': '*'})
+    from flask import Response
+    return Response(drive(events), mimetype='text/event-stream', headers=headers)
+
+
+def follower_response(flight, transport):
+    print(f"Coalesced onto in-flight request {flight.key[:12]} "
+          f"({len(flight.events)} events buffered, finished={flight.finished_at is not None})")
+    return sse_response(flight.follow(), transport, {'X-Coalesced': '1'})
+
+
+def profiled_stream(events, profile):
+    try:
+        yield from events
+    finally:
+        profile.stop()
+
+
 @functions_framework.http
 @cross_origin()
 def chat(request):
@@ -216,7 +1343,7 @@ def chat(request):
     Cloud Function to handle all chat scenarios with Claude.
 
     Expects JSON payload with:
-    - messages: Array of message objects with 'role' and 'content'
+    - messages: Array of message objects with 'role' and 'content' (optional 'sent_at', epoch ms)
     - image: (optional) Object with 'data' (base64) and 'media_type'
     - document: (optional) Object with 'url' or 'data' for PDF files
     - system_prompt: (optional) System prompt for context
@@ -225,21 +1352,184 @@ def chat(request):
     - disable_thinking: (optional) Boolean to disable thinking mode
     - use_fast_model: (optional) Boolean to use Sonnet instead of Opus
     - enable_web_search: (optional) Boolean to enable web search tool
+    - history_image_window: (optional) Keep only the newest N historical images inline
+      (default HISTORY_IMAGE_WINDOW; -1 keeps all)
+    - history_image_policy: (optional) 'placeholder' or 'text' for the image turns elided
+    - stream_thinking: (optional) Boolean to stream thinking as throttled 'thinking_chunk' events
+    - slim_done: (optional) Boolean; the 'done' event carries content_length + content_sha256
+      (UTF-8) instead of repeating text the client already received as chunks
+    - input_token_budget: (optional) Estimated input-token budget; the oldest turns are dropped
+      to fit (default INPUT_TOKEN_BUDGET; -1 = no budget)
+    - stream_wrapped: (optional) Boolean; completed paragraphs are wrapped (as wrap_content)
+      while the answer streams and sent as 'wrapped_chunk' events {index, attempt, wrapped,
+      sep, path}, all before 'done'
+    - coalesce: (optional) Boolean, default true; false opts out of sharing the stream of an
+      identical in-flight request from the same caller (see COALESCE). A request that joined one
+      gets X-Coalesced: 1
+    - user_id: (optional) The app user sending the request; only scopes coalescing
+
+    The 'done' event carries 'timing' in milliseconds from the start of the request:
+    attachment_fetch (time blocked on attachments), message_build (the rest of request
+    preparation), upstream_connect (stream opened to response headers), ttft_thinking,
+    ttft_text, retry (time in fallback attempts) and total. The preparation stages are also
+    sent as a Server-Timing header; the streaming ones happen after the headers are gone.
+
+    GET /warmup (or ?warmup=1) builds the clients and opens their connections (see warmup())
+    and returns the step timings with the module's import time.
+
+    Or, instead of messages, the wrap modes (plain JSON responses, not SSE):
+    - wrap_content: a string -> {'wrapped', 'model', 'usage', 'path'}
+    - wrap_contents: up to WRAP_BATCH_MAX strings -> {'results': [{'wrapped', 'usage', 'path'} or
+      {'error'}], 'model', 'usage'}, results in input order
+      path is 'rules' (settled locally by wrap_by_rules), 'cache' (an earlier model result for
+      the same input, prompt version and model) — both without usage — or 'model'; send
+      use_rules=false to skip the rule engine
+
+    A request can be profiled on demand (see PROFILE_REQUESTS / PROFILE_TOKEN); its profile id
+    comes back in the X-Profile-Id header.
     """
+    if not PROFILE_REQUESTS and not (PROFILE_TOKEN and request.method != 'OPTIONS'
+                                     and request.headers.get('X-Profile-Token') == PROFILE_TOKEN):
+        return handle_chat(request)
+
+    # A profiled request measures its own generation, so it never joins a shared one.
+    from flask import make_response
+    trace = request.headers.get('X-Cloud-Trace-Context', '').split('/')[0]
+    request_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{trace or os.urandom(8).hex()}"
+    profile = RequestProfile(request_id)
+    profile.start()
+    try:
+        response = make_response(handle_chat(request, coalesce=False))
+    except BaseException:
+        profile.stop()
+        raise
+    response.headers['X-Profile-Id'] = request_id
+    if response.is_streamed:
+        # The SSE body runs after chat() has returned; stop when the last event is sent.
+        response.response = profiled_stream(response.response, profile)
+    else:
+        profile.stop()
+    return response
+
+
+async def prefetch_attachments(request_json):
+    """Resolve every attachment of a chat request on the event loop, as chat_response's
+    `prefetched` map. At most ATTACHMENT_FETCH_WORKERS are in flight at once, as on the Flask
+    path's attachment pool."""
+    window = int_option(request_json, 'history_image_window', HISTORY_IMAGE_WINDOW)
+    elided = elided_history_images(request_json.get('messages', []), window)
+    urls = list(dict(attachment_urls(request_json, elided)).items())
+    slots = asyncio.Semaphore(ATTACHMENT_FETCH_WORKERS)
+
+    async def resolve(url, fallback_media_type):
+        if url.startswith('data:'):
+            return parse_data_url(url, fallback_media_type)
+        if url.startswith('http'):
+            async with slots:
+                return await download_file_from_storage_async(url)
+        raise ValueError(f"Unsupported attachment URL prefix: {url[:60]}")
+
+    results = await asyncio.gather(*(resolve(u, f) for u, f in urls), return_exceptions=True)
+    return {url: result for (url, _), result in zip(urls, results)}
+
+
+async def chat_async(request):
+    """chat() for an ASGI server, with the same request body, modes and SSE contract.
+
+    A Flask worker thread is pinned for the whole of a minutes-long thinking stream; here the
+    stream and the Storage reads are awaited on the event loop, so instance concurrency is bound
+    by I/O rather than by threads. The CPU work before the stream starts (message building,
+    base64, transcodes, the context estimates' image header decodes) and the wrap modes' blocking
+    model calls run on a worker thread, so one large request does not stall the other streams.
+    Served with FUNCTION_USE_ASGI=1 and entry point chat_async (CHAT_ASGI=1 ./deploy.sh chat). The
+    ASGI server treats any coroutine target as an HTTP function, so no decorator is needed —
+    importing functions_framework.aio here would put Starlette on every cold start of the Flask
+    path too.
+    The PROFILE_* hook is chat() only.
+    """
+    from starlette.responses import JSONResponse, Response as StarletteResponse
+    cors = {'Access-Control-Allow-Origin': '*'}
+    if request.method == 'OPTIONS':
+        return StarletteResponse(status_code=204, headers={
+            **cors,
+            'Access-Control-Allow-Methods': 'POST',
+            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Max-Age': '3600'
+        })
+    if request.url.path.rstrip('/').endswith('/warmup') or request.query_params.get('warmup'):
+        timings = await asyncio.to_thread(warmup)
+        _anthropic_async()
+        print(f"Warmup (asgi): import_s={IMPORT_SECONDS:.3f} {json.dumps(timings)}")
+        return JSONResponse({'warm': True, 'import_s': round(IMPORT_SECONDS, 3), 'steps': timings},
+                            headers=cors)
+
+    try:
+        request_json = await request.json()
+    except Exception:
+        request_json = None
+    if request_json and 'messages' in request_json and not any(
+            k in request_json for k in ('wrap_content', 'wrap_contents')):
+        caller = caller_identity(request.headers, request.client.host if request.client else None)
+        flight, leader = claim_flight(request_json, caller)
+        if not leader:
+            return follower_response(flight, 'asgi')
+        try:
+            prefetched = await prefetch_attachments(request_json)
+        except BaseException as e:
+            if flight is not None:
+                flight.fail(str(e))
+            if not isinstance(e, Exception):
+                raise
+            print(f"Error in chat function: {str(e)}")
+            return JSONResponse({'error': str(e)}, status_code=500, headers=cors)
+        result = await asyncio.to_thread(chat_response, request_json, prefetched, transport='asgi',
+                                         coalesce=False, loop=asyncio.get_running_loop(),
+                                         caller=caller, flight=flight)
+    else:
+        # Wrap modes and request errors: plain JSON, possibly after blocking model calls.
+        result = await asyncio.to_thread(chat_response, request_json)
+    if isinstance(result, tuple):
+        content, status = result
+        return JSONResponse(content, status_code=status, headers=cors)
+    return result
+
+
+def handle_chat(request, coalesce=True):
+    """The chat() entry point proper, without the profiling wrapper."""
 
     # Handle preflight requests
     if request.method == 'OPTIONS':
         headers = {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'POST',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Headers': 'Content-Type, X-Profile-Token',
             'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
 
-    try:
-        request_json = request.get_json(silent=True)
+    if request.path.rstrip('/').endswith('/warmup') or request.args.get('warmup'):
+        timings = warmup()
+        print(f"Warmup: import_s={IMPORT_SECONDS:.3f} {json.dumps(timings)}")
+        return {'warm': True, 'import_s': round(IMPORT_SECONDS, 3), 'steps': timings}, 200
+
+    return chat_response(request.get_json(silent=True), coalesce=coalesce,
+                         caller=caller_identity(request.headers, request.remote_addr))
+
 
+def chat_response(request_json, prefetched=None, transport='wsgi', coalesce=True, loop=None,
+                  caller='', flight=None):
+    """A chat() request body to its response, shared by the Flask and ASGI entry points.
+
+    `prefetched` maps attachment URLs to (base64_data, media_type), or to the exception that
+    resolving them raised, already settled by the caller; anything else is fetched here on the
+    attachment pool. With transport 'wsgi' the stream is a Flask Response driven by the sync
+    Vertex client; with 'asgi' it is a Starlette
+    StreamingResponse over the async client, and no thread is held while it streams; `loop` is
+    the server's event loop, which a coalesced flight's producer is started on.
+    `coalesce=False` keeps this request off the single-flight map (see COALESCE); `caller`
+    (caller_identity) scopes it. `flight` is one the caller already leads (claim_flight).
+    """
+    try:
         # --- wrap_content mode: convert Chinese text to ruby/span markup ---
         if request_json and 'wrap_content' in request_json:
             content = request_json['wrap_content']
@@ -247,22 +1537,43 @@ def chat(request):
                 return {'wrapped': content or ''}, 200
             use_fast = bool(request_json.get('use_fast_model', True))
             model = MODEL_FAST if use_fast else MODEL_DEFAULT
+            use_rules = WRAP_RULES and bool(request_json.get('use_rules', True))
             print(f"wrap_content mode: model={model} content_len={len(content)}")
-            resp = client.messages.create(
-                model=model,
-                max_tokens=MAX_TOKENS_SONNET,
-                system=WRAP_PROMPT,
-                messages=[{"role": "user", "content": content}],
-            )
-            wrapped = "".join(
-                b.text for b in resp.content if getattr(b, "type", None) == "text"
-            )
-            print(f"wrap_content done: wrapped_len={len(wrapped)} in={resp.usage.input_tokens} out={resp.usage.output_tokens}")
-            return {'wrapped': wrapped, 'model': model}, 200
+            wrapped, usage, path = wrap_text(content, model, use_rules=use_rules)
+            print(f"wrap_content done: path={path} wrapped_len={len(wrapped)} usage={json.dumps(usage)}")
+            return {'wrapped': wrapped, 'model': model, 'usage': usage, 'path': path}, 200
+
+        if request_json and 'wrap_contents' in request_json:
+            contents = request_json['wrap_contents']
+            if not isinstance(contents, list):
+                return {'error': 'wrap_contents must be a list of strings'}, 400
+            if len(contents) > WRAP_BATCH_MAX:
+                return {'error': f'wrap_contents is limited to {WRAP_BATCH_MAX} items'}, 400
+            use_fast = bool(request_json.get('use_fast_model', True))
+            model = MODEL_FAST if use_fast else MODEL_DEFAULT
+            use_rules = WRAP_RULES and bool(request_json.get('use_rules', True))
+            print(f"wrap_contents mode: model={model} items={len(contents)}")
+            results, usage = wrap_batch(contents, model, use_rules=use_rules)
+            errors = sum(1 for r in results if 'error' in r)
+            by_rules = sum(1 for r in results if r.get('path') == 'rules')
+            print(f"wrap_contents done: items={len(results)} rules={by_rules} errors={errors} usage={json.dumps(usage)}")
+            return {'results': results, 'model': model, 'usage': usage}, 200
 
         if not request_json or 'messages' not in request_json:
             return {'error': 'Messages are required'}, 400
 
+        # A duplicate of a request in flight follows its stream before any attachment is read.
+        if flight is None:
+            flight, leader = claim_flight(request_json, caller, coalesce)
+            if not leader:
+                return follower_response(flight, transport)
+
+        started = time.perf_counter()
+        fetch_wait = [0.0]     # seconds blocked on attachment downloads, summed
+
+        def since_start_ms():
+            return round((time.perf_counter() - started) * 1000)
+
         messages = request_json.get('messages', [])
         image_data = request_json.get('image')
         document_data = request_json.get('document')
@@ -271,6 +1582,12 @@ def chat(request):
         disable_thinking = request_json.get('disable_thinking', False)
         use_fast_model = request_json.get('use_fast_model', False)
         enable_web_search = request_json.get('enable_web_search', False)
+        history_image_window = int_option(request_json, 'history_image_window', HISTORY_IMAGE_WINDOW)
+        history_image_policy = request_json.get('history_image_policy', HISTORY_IMAGE_POLICY)
+        stream_thinking = bool(request_json.get('stream_thinking', False))
+        slim_done = bool(request_json.get('slim_done', False))
+        input_token_budget = int_option(request_json, 'input_token_budget', INPUT_TOKEN_BUDGET)
+        stream_wrapped = bool(request_json.get('stream_wrapped', False))
 
         # Select model and set per-model max output tokens
         model = MODEL_FAST if use_fast_model else MODEL_DEFAULT
@@ -278,68 +1595,78 @@ def chat(request):
         print(f"Request config: model={model}, disable_thinking={disable_thinking}, use_cache={use_cache}, max_tokens={max_tokens}, web_search={enable_web_search}")
         print(f"Full request payload keys: {list(request_json.keys())}")
 
-        # Per-request cache so the same Storage URL isn't downloaded twice
-        # (relevant when an image appears in history AND in the current turn,
-        # or when the same image is referenced across multiple historical turns).
+        # Per-request single-flight map: url -> Future. The first caller for a URL starts the
+        # download, every later caller (the same image in history AND the current turn, or one
+        # image referenced by several turns) waits on the same Future instead of downloading again.
         download_cache = {}
+        download_lock = threading.Lock()
 
-        def fetch_attachment(url, fallback_media_type='image/jpeg'):
-            """Resolve a Storage URL or data: URL to (base64_data, media_type), cached per-request."""
-            if url in download_cache:
-                return download_cache[url]
+        def resolve_attachment(url, fallback_media_type):
             if url.startswith('http'):
                 b64, mime = download_file_from_storage(url)
             elif url.startswith('data:'):
-                b64 = url.split(',', 1)[1]
-                mime_part = url.split(',', 1)[0]
-                mime = mime_part.split(';')[0].split(':', 1)[1] if ':' in mime_part else fallback_media_type
+                b64, mime = parse_data_url(url, fallback_media_type)
             else:
                 raise ValueError(f"Unsupported attachment URL prefix: {url[:60]}")
-            download_cache[url] = (b64, mime)
-            print(f"  fetch_attachment: url={url[:80]}... mime={mime}, b64_len={len(b64)}")
-            return download_cache[url]
+            return b64, mime
+
+        def start_fetch(url, fallback_media_type='image/jpeg'):
+            """Start resolving `url` on the attachment pool unless it is already in flight."""
+            with download_lock:
+                fut = download_cache.get(url)
+                if fut is None:
+                    if prefetched and url in prefetched:
+                        fut = cf.Future()
+                        if isinstance(prefetched[url], BaseException):
+                            fut.set_exception(prefetched[url])
+                        else:
+                            fut.set_result(prefetched[url])
+                    else:
+                        fut = attachment_pool.submit(resolve_attachment, url, fallback_media_type)
+                    download_cache[url] = fut
+            return fut
+
+        def fetch_attachment(url, fallback_media_type='image/jpeg'):
+            """Resolve a Storage URL or data: URL to (base64_data, media_type), single-flight per request."""
+            waited = time.perf_counter()
+            try:
+                return start_fetch(url, fallback_media_type).result()
+            finally:
+                fetch_wait[0] += time.perf_counter() - waited
+
+        # Apply the history image window before anything is downloaded, so elided photos are
+        # never fetched at all.
+        elided_image_idxs = elided_history_images(messages, history_image_window)
+        if elided_image_idxs:
+            print(f"History image window={history_image_window}: eliding oldest "
+                  f"{len(elided_image_idxs)} historical image(s) (policy={history_image_policy})")
+
+        # Prefetch: collect every attachment URL the request will need and start them all now,
+        # so the message-building loop below only ever waits on downloads already in flight.
+        for url, fallback_media_type in attachment_urls(request_json, elided_image_idxs):
+            start_fetch(url, fallback_media_type)
+        if download_cache:
+            print(f"Prefetching {len(download_cache)} attachment(s), workers={ATTACHMENT_FETCH_WORKERS}, "
+                  f"attachment_cache={json.dumps(attachment_cache.stats())}")
 
         # Resolve current-turn (top-level) image to {data, media_type}
         if image_data:
             if 'url' in image_data:
                 b64, mime = fetch_attachment(image_data['url'], image_data.get('type', 'image/jpeg'))
                 image_data = {'data': b64, 'media_type': mime}
-                print(f"Current-turn image: media_type={mime}, data_length={len(b64)}")
 
         # Resolve current-turn (top-level) document to {data, media_type}
         if document_data:
             if 'url' in document_data:
                 b64, mime = fetch_attachment(document_data['url'], 'application/pdf')
                 document_data = {'data': b64, 'media_type': mime}
-                print(f"Current-turn document: media_type={mime}, data_length={len(b64)}")
 
         # Prepare messages (excluding system prompt)
         all_messages = []
 
-        # First pass: collect assistant message indices with content
-        assistant_indices = []
-        for i, msg in enumerate(messages):
-            if msg['role'] == 'assistant' and msg.get('content', '').strip():
-                assistant_indices.append(i)
-
-        # Cache last 2 assistant messages (max 4 cache blocks total: 1 system + 2 assistant + 1 spare)
-        max_cached_assistant_messages = 2
-        cached_assistant_indices = set(assistant_indices[-max_cached_assistant_messages:]) if assistant_indices else set()
-
-        print(f"Assistant message indices: {assistant_indices}")
-        print(f"Will cache assistant messages at indices: {cached_assistant_indices}")
-
-        # Find the latest HISTORICAL message that has an image attached.
-        # We'll mark its image block with cache_control so the heavy base64
-        # payload stays in Anthropic's prompt cache across follow-up turns.
-        # (Current-turn image is fresh; we don't cache it since the next turn
-        # will move it into history and re-mark it then.)
-        latest_historical_image_idx = -1
-        for i, msg in enumerate(messages[:-1]):
-            if msg.get('image') and msg['image'].get('url'):
-                latest_historical_image_idx = i
-        if latest_historical_image_idx >= 0:
-            print(f"Latest historical image at index {latest_historical_image_idx} - will mark with cache_control")
+        # Index in all_messages of the last elided image turn. Everything up to it stays
+        # byte-identical until the window's next stride, so the cache planner pins it.
+        elided_boundary = None
 
         # Process all messages. Each message may carry its own image/document
         # via msg.image / msg.document (Storage URL refs). The current/last
@@ -359,17 +1686,19 @@ def chat(request):
                 msg_document = document_data
             else:
                 # Historical message — download per-message refs from Storage
-                if msg.get('image') and msg['image'].get('url'):
+                if i in elided_image_idxs:
+                    if not text_content.strip():
+                        text_content = HISTORY_IMAGE_PLACEHOLDER
+                    elif history_image_policy != 'text':
+                        text_content = f"{HISTORY_IMAGE_PLACEHOLDER}\n\n{text_content}"
+                elif msg.get('image') and msg['image'].get('url'):
                     b64, mime = fetch_attachment(msg['image']['url'], msg['image'].get('type', 'image/jpeg'))
                     msg_image = {'data': b64, 'media_type': mime}
-                    print(f"  Historical image at msg {i}: mime={mime}, b64_len={len(b64)}")
                 if msg.get('document') and msg['document'].get('url'):
                     b64, mime = fetch_attachment(msg['document']['url'], 'application/pdf')
                     msg_document = {'data': b64, 'media_type': mime}
-                    print(f"  Historical document at msg {i}: mime={mime}, b64_len={len(b64)}")
 
             has_msg_attachment = msg_image or msg_document
-            print(f"Processing message {i}: role={msg['role']}, content_length={len(text_content)}, has_attachment={bool(has_msg_attachment)}")
 
             # Skip messages that have neither text nor attachment
             if not text_content.strip() and not has_msg_attachment:
@@ -379,20 +1708,14 @@ def chat(request):
                 message_content = []
 
                 if msg_image:
-                    img_block = {
+                    message_content.append({
                         'type': 'image',
                         'source': {
                             'type': 'base64',
                             'media_type': msg_image['media_type'],
                             'data': msg_image['data']
                         }
-                    }
-                    # Cache the latest historical image so subsequent turns
-                    # don't re-pay tokens for the same base64 payload.
-                    if use_cache and i == latest_historical_image_idx:
-                        img_block['cache_control'] = {'type': 'ephemeral'}
-                        print(f"  Added cache_control to image block at msg {i}")
-                    message_content.append(img_block)
+                    })
 
                 if msg_document:
                     message_content.append({
@@ -416,22 +1739,17 @@ def chat(request):
                 })
             else:
                 # Text-only message
-                content_block = {
-                    'type': 'text',
-                    'text': text_content
-                }
-
-                # Cache selected assistant messages (existing behavior)
-                if use_cache and msg['role'] == 'assistant' and i in cached_assistant_indices:
-                    if text_content.strip():
-                        content_block['cache_control'] = {'type': 'ephemeral'}
-
                 all_messages.append({
                     'role': msg['role'],
-                    'content': [content_block]
+                    'content': [{
+                        'type': 'text',
+                        'text': text_content
+                    }]
                 })
 
-        print(f"Total messages after processing: {len(all_messages)}")
+            if i in elided_image_idxs:
+                elided_boundary = len(all_messages) - 1
+
 
         # Prepare the message options
         message_options = {
@@ -467,26 +1785,94 @@ def chat(request):
         # Add system prompt as top-level parameter if provided
         if system_prompt:
             print(f"Adding system prompt, length={len(system_prompt)}, use_cache={use_cache}")
-            system_content = {
+            message_options['system'] = [{
                 'type': 'text',
                 'text': system_prompt
-            }
-            if use_cache and system_prompt.strip():
-                system_content['cache_control'] = {'type': 'ephemeral'}
-            message_options['system'] = [system_content]
+            }]
 
-        # Create a generator for streaming response
-        def generate():
+        # Fit the finished request under the input budget. Once trimming starts, the first turn
+        # plus its constant note is the stable prefix to pin, unless an elided image turn that
+        # survived the trim sits further in.
+        budget_report = None
+        if input_token_budget >= 0:
+            kept, dropped, est_before, est_after = context.trim_to_budget(
+                message_options.get('system'), all_messages, input_token_budget, IMAGE_LIMITS)
+            if dropped:
+                offset = 1 if all_messages[0].get('role') == 'user' else 0
+                if elided_boundary is not None and elided_boundary >= offset + dropped:
+                    elided_boundary -= dropped
+                else:
+                    elided_boundary = 0 if offset else None
+                all_messages = kept
+                message_options['messages'] = all_messages
+            budget_report = {'budget': input_token_budget, 'messages_dropped': dropped,
+                             'estimated_before': est_before, 'estimated_after': est_after}
+            print(f"Context budget: {json.dumps(budget_report)}")
+            if est_after > input_token_budget:
+                print(f"WARNING: request still over budget after trimming ({est_after} > {input_token_budget})")
+
+        # Place the cache breakpoints over the finished request (see context.plan_cache_breakpoints).
+        # Breakpoint lifetimes follow the chat's cadence: the client stamps each message with
+        # sent_at (epoch ms), and the gaps between recent user turns decide 5m vs 1h.
+        cache_plan = None
+        cadence = None
+        if use_cache:
+            long_share, gaps = context.long_gap_share(
+                [m['sent_at'] / 1000 for m in messages[:-1]
+                 if m.get('role') == 'user' and isinstance(m.get('sent_at'), (int, float))],
+                time.time())
+            cadence = {'recent_gaps_s': gaps, 'long_gap_share': long_share, 'ttl_1h_enabled': CACHE_TTL_1H}
+            cache_plan = context.plan_cache_breakpoints(message_options.get('system'), all_messages,
+                                                        IMAGE_LIMITS, pinned_message=elided_boundary,
+                                                        long_share=long_share if CACHE_TTL_1H else None)
+            print(f"Cache plan: {json.dumps(cache_plan)} cadence={json.dumps(cadence)}")
+
+        # Preparation is over: everything from here on happens while the response streams.
+        fetch_ms = round(fetch_wait[0] * 1000)
+        timing = {'attachment_fetch': fetch_ms, 'message_build': since_start_ms() - fetch_ms}
+
+        # The one log line per request, in place of the old per-message prints.
+        def log_request(**fields):
+            record = {'event': 'chat_request', 'model': model, 'messages': len(messages),
+                      'sent_messages': len(all_messages), 'attachments': len(download_cache),
+                      'history_images_elided': len(elided_image_idxs),
+                      'messages_dropped': budget_report['messages_dropped'] if budget_report else 0,
+                      'timing_ms': timing, **fields}
+            print(json.dumps(record))
+
+        # Create a generator for streaming response. It is written once, against the async
+        # stream interface (see open_stream); the Flask path drives it with drive().
+        async def generate():
             full_response = ''
             thinking_content = ''
             is_thinking = False
             citations = []
             web_search_queries = []
             current_block_type = None
+            thinking_pending = ''
+            thinking_flushed_at = 0.0
+            text_pending = ''
+            text_flushed_at = 0.0
+            # One ParagraphWrapper per streamed attempt; the last one is the answer's.
+            wrappers = [ParagraphWrapper(MODEL_FAST)] if stream_wrapped else []
 
             try:
-                with client.messages.stream(**message_options) as stream:
-                    for event in stream:
+                stream_opened = time.perf_counter()
+                async with open_stream(transport, message_options) as stream:
+                    timing['upstream_connect'] = round((time.perf_counter() - stream_opened) * 1000)
+                    async for event in paced(stream, SSE_FLUSH_INTERVAL_S):
+                        if event is None:
+                            # The upstream is quiet: send what the throttles are holding back.
+                            if text_pending:
+                                yield sse_event({'type': 'chunk', 'text': text_pending})
+                                text_pending = ''
+                                text_flushed_at = time.monotonic()
+                            if (thinking_pending and time.monotonic() - thinking_flushed_at
+                                    >= THINKING_CHUNK_INTERVAL_S):
+                                yield sse_event({'type': 'thinking_chunk', 'text': thinking_pending})
+                                thinking_pending = ''
+                                thinking_flushed_at = time.monotonic()
+                            continue
                         if not hasattr(event, 'type'):
                             continue
 
@@ -509,24 +1895,67 @@ def chat(request):
                             if hasattr(event, 'delta'):
                                 # ThinkingDelta: attribute is .thinking, not .text.
                                 # Opus 4.7 emits these when display='summarized'.
+                                thinking_delta = None
                                 if hasattr(event.delta, 'thinking'):
-                                    thinking_content += event.delta.thinking
+                                    thinking_delta = event.delta.thinking
                                 elif hasattr(event.delta, 'text'):
                                     text = event.delta.text
                                     if is_thinking:
-                                        thinking_content += text
+                                        thinking_delta = text
                                     else:
+                                        timing.setdefault('ttft_text', since_start_ms())
                                         full_response += text
-                                        yield f"data: {json.dumps({'type': 'chunk', 'text': text})}\n\n"
+                                        text_pending += text
+                                        now = time.monotonic()
+                                        if (len(text_pending) >= SSE_FLUSH_CHARS
+                                                or now - text_flushed_at >= SSE_FLUSH_INTERVAL_S):
+                                            yield sse_event({'type': 'chunk', 'text': text_pending})
+                                            text_pending = ''
+                                            text_flushed_at = now
+                                        if wrappers:
+                                            wrappers[-1].feed(text)
+                                            for wrapped_event in wrappers[-1].ready():
+                                                yield wrapped_event
                                 elif hasattr(event.delta, 'partial_json'):
                                     # This is the search query being built
                                     pass
 
+                                if thinking_delta:
+                                    timing.setdefault('ttft_thinking', since_start_ms())
+                                    thinking_content += thinking_delta
+                                    if stream_thinking:
+                                        thinking_pending += thinking_delta
+                                        now = time.monotonic()
+                                        if now - thinking_flushed_at >= THINKING_CHUNK_INTERVAL_S:
+                                            yield sse_event({'type': 'thinking_chunk', 'text': thinking_pending})
+                                            thinking_pending = ''
+                                            thinking_flushed_at = now
+
+                        elif event.type == 'message_delta' and refusal_signalled(event):
+                            # A refusal is final the moment it is signalled. Stop reading and go
+                            # straight to the retry chain instead of waiting out the stream.
+                            print("Refusal signalled — abandoning the primary stream")
+                            break
+
                         elif event.type == 'content_block_stop':
                             if is_thinking:
                                 is_thinking = False
+                            if thinking_pending:
+                                yield sse_event({'type': 'thinking_chunk', 'text': thinking_pending})
+                                thinking_pending = ''
+                            if text_pending:
+                                yield sse_event({'type': 'chunk', 'text': text_pending})
+                                text_pending = ''
                             current_block_type = None
 
+                    # A stream that ends without closing its block must not swallow the tail.
+                    if thinking_pending:
+                        yield sse_event({'type': 'thinking_chunk', 'text': thinking_pending})
+                        thinking_pending = ''
+                    if text_pending:
+                        yield sse_event({'type': 'chunk', 'text': text_pending})
+                        text_pending = ''
+
                     # Extract citations from the final message snapshot
                     final_message = stream.current_message_snapshot
                     for block in final_message.content:
@@ -553,6 +1982,13 @@ def chat(request):
                         usage['cache_creation_tokens'] = final_message.usage.cache_creation_input_tokens
                     if hasattr(final_message.usage, 'cache_read_input_tokens'):
                         usage['cache_read_tokens'] = final_message.usage.cache_read_input_tokens
+                    # Split of what was written by lifetime, to judge the TTL decision after the fact.
+                    cache_creation = getattr(final_message.usage, 'cache_creation', None)
+                    if cache_creation is not None:
+                        usage['cache_creation_5m_tokens'] = getattr(cache_creation, 'ephemeral_5m_input_tokens', 0) or 0
+                        usage['cache_creation_1h_tokens'] = getattr(cache_creation, 'ephemeral_1h_input_tokens', 0) or 0
+                    if cache_plan is not None:
+                        usage['cache_ttl'] = {**cadence, 'breakpoints': [b['ttl'] for b in cache_plan['breakpoints']]}
                     if hasattr(final_message.usage, 'server_tool_use') and final_message.usage.server_tool_use:
                         if hasattr(final_message.usage.server_tool_use, 'web_search_requests'):
                             usage['web_search_requests'] = final_message.usage.server_tool_use.web_search_requests
@@ -572,8 +2008,20 @@ def chat(request):
                         'thinking': thinking_content if thinking_content else None,
                         'usage': usage,
                         'cached': 'cache_read_tokens' in usage,
-                        'model': model
+                        'model': model,
+                        'attachment_cache': attachment_cache.stats(),
+                        'history_images_elided': len(elided_image_idxs),
                     }
+                    if budget_report is not None:
+                        done_payload['context_budget'] = budget_report
+                    if cache_plan is not None:
+                        done_payload['cache_plan'] = {
+                            'breakpoints': [f"{b['reason']}@{b['message']}.{b['block']}/{b['ttl']}"
+                                            for b in cache_plan['breakpoints']],
+                            'estimated_input_tokens': cache_plan['estimated_input_tokens'],
+                            'predicted_read_tokens': cache_plan['predicted_read_tokens'],
+                            'actual_read_tokens': usage.get('cache_read_tokens') or 0,
+                        }
 
                     if unique_citations:
                         done_payload['citations'] = unique_citations
@@ -592,26 +2040,70 @@ def chat(request):
                         print("Web search was ENABLED but the model never invoked it "
                               "(0 queries, 0 citations)")
 
+                    streamed_response = full_response
                     stop_reason = getattr(final_message, 'stop_reason', None)
                     print(f"Usage: {json.dumps(usage)} stop_reason={stop_reason} text_len={len(full_response)} thinking_len={len(thinking_content)}")
                     done_payload['stop_reason'] = stop_reason
 
-                    # Helper: run a non-thinking attempt synchronously, return (text, stop_reason).
-                    # Doesn't yield chunks — callers replace done_payload.content with the result.
-                    def run_attempt(opts, label):
+                    # Helper: stream one fallback attempt to the client as ordinary chunk events
+                    # tagged with its attempt number, coalesced like the primary stream. The 'retry'
+                    # event sent before it tells the client to discard the previous attempt's text.
+                    # Appends (text, stop_reason, usage) to `result`: an async generator cannot
+                    # return a value.
+                    async def stream_attempt(opts, label, attempt, result):
+                        attempt_started = time.perf_counter()
+                        try:
+                            async for ev in attempt_events(opts, label, attempt, result):
+                                yield ev
+                        finally:
+                            timing['retry'] = timing.get('retry', 0) + round(
+                                (time.perf_counter() - attempt_started) * 1000)
+
+                    async def attempt_events(opts, label, attempt, result):
                         text = ''
-                        with client.messages.stream(**opts) as s:
-                            for ev in s:
-                                if (getattr(ev, 'type', None) == 'content_block_delta'
+                        pending = ''
+                        flushed_at = 0.0
+                        if wrappers:
+                            wrappers[-1].cancel()
+                            wrappers.append(ParagraphWrapper(MODEL_FAST, attempt))
+                        async with open_stream(transport, opts) as s:
+                            async for ev in paced(s, SSE_FLUSH_INTERVAL_S):
+                                if ev is None:
+                                    if pending:
+                                        yield sse_event({'type': 'chunk', 'text': pending, 'attempt': attempt})
+                                        pending = ''
+                                        flushed_at = time.monotonic()
+                                    continue
+                                ev_type = getattr(ev, 'type', None)
+                                if (ev_type == 'content_block_delta'
                                         and hasattr(ev, 'delta')
                                         and hasattr(ev.delta, 'text')):
                                     text += ev.delta.text
+                                    pending += ev.delta.text
+                                    now = time.monotonic()
+                                    if (len(pending) >= SSE_FLUSH_CHARS
+                                            or now - flushed_at >= SSE_FLUSH_INTERVAL_S):
+                                        yield sse_event({'type': 'chunk', 'text': pending, 'attempt': attempt})
+                                        pending = ''
+                                        flushed_at = now
+                                    if wrappers:
+                                        wrappers[-1].feed(ev.delta.text)
+                                        for wrapped_event in wrappers[-1].ready():
+                                            yield wrapped_event
+                                elif ev_type == 'content_block_stop' and pending:
+                                    yield sse_event({'type': 'chunk', 'text': pending, 'attempt': attempt})
+                                    pending = ''
+                                elif ev_type == 'message_delta' and refusal_signalled(ev):
+                                    print(f"{label}: refusal signalled — abandoning stream")
+                                    break
+                            if pending:
+                                yield sse_event({'type': 'chunk', 'text': pending, 'attempt': attempt})
                             msg = s.current_message_snapshot
                             sr = getattr(msg, 'stop_reason', None)
                             u = {'input_tokens': msg.usage.input_tokens,
                                  'output_tokens': msg.usage.output_tokens}
                             print(f"{label} usage: {json.dumps(u)} stop_reason={sr} text_len={len(text)}")
-                            return text, sr, u
+                            result.append((text, sr, u))
 
                     # Refusal-aware retry chain (adapts based on initial config):
                     #   If thinking was OFF (e.g. Explain template):
@@ -631,9 +2123,13 @@ def chat(request):
                                 retry1_opts.pop('output_config', None)
                                 if 'tools' not in retry1_opts:
                                     retry1_opts['tools'] = [{"type": "web_search_20250305", "name": "web_search", "max_uses": 3}]
-                                yield f"data: {json.dumps({'type': 'retry', 'attempt': 1, 'model': model, 'reason': 'Content filter triggered — retrying with web search'})}\n\n"
+                                yield sse_event({'type': 'retry', 'attempt': 1, 'model': model, 'reason': 'Content filter triggered — retrying with web search'})
                                 print(f"Refusal/empty — retry 1 (same model {model}, no thinking, + web search)")
-                                text2, stop2, usage2 = run_attempt(retry1_opts, f"Retry 1 ({model} + web)")
+                                attempt_result = []
+                                async for ev in stream_attempt(retry1_opts, f"Retry 1 ({model} + web)", 1, attempt_result):
+                                    yield ev
+                                text2, stop2, usage2 = attempt_result[0]
+                                streamed_response = text2
 
                                 done_payload['retry_used'] = True
                                 done_payload['retry_usage'] = usage2
@@ -642,7 +2138,7 @@ def chat(request):
 
                                 if stop2 == 'refusal':
                                     # Retry 2: Sonnet, no thinking, no web
-                                    yield f"data: {json.dumps({'type': 'retry', 'attempt': 2, 'model': MODEL_FAST, 'reason': 'Still blocked — trying Sonnet'})}\n\n"
+                                    yield sse_event({'type': 'retry', 'attempt': 2, 'model': MODEL_FAST, 'reason': 'Still blocked — trying Sonnet'})
                                     sonnet_opts = dict(message_options)
                                     sonnet_opts['model'] = MODEL_FAST
                                     sonnet_opts['max_tokens'] = MAX_TOKENS_SONNET
@@ -650,7 +2146,11 @@ def chat(request):
                                     sonnet_opts.pop('output_config', None)
                                     sonnet_opts.pop('tools', None)
                                     print(f"Retry 1 also refused — retry 2 (Sonnet, no thinking, no web)")
-                                    text3, stop3, usage3 = run_attempt(sonnet_opts, "Retry 2 (Sonnet)")
+                                    attempt_result = []
+                                    async for ev in stream_attempt(sonnet_opts, "Retry 2 (Sonnet)", 2, attempt_result):
+                                        yield ev
+                                    text3, stop3, usage3 = attempt_result[0]
+                                    streamed_response = text3
                                     done_payload['retry2_usage'] = usage3
                                     done_payload['retry2_stop_reason'] = stop3
                                     done_payload['retry2_model'] = MODEL_FAST
@@ -671,9 +2171,13 @@ def chat(request):
                                 retry_opts['model'] = MODEL_RETRY
                                 retry_opts['thinking'] = {'type': 'adaptive'}
                                 retry_opts.pop('output_config', None)
-                                yield f"data: {json.dumps({'type': 'retry', 'attempt': 1, 'model': MODEL_RETRY, 'reason': 'Content filter triggered — retrying with a different model'})}\n\n"
+                                yield sse_event({'type': 'retry', 'attempt': 1, 'model': MODEL_RETRY, 'reason': 'Content filter triggered — retrying with a different model'})
                                 print(f"Refusal/empty — retry 1 ({MODEL_RETRY}, adaptive thinking, full context)")
-                                text2, stop2, usage2 = run_attempt(retry_opts, f"Retry 1 ({MODEL_RETRY})")
+                                attempt_result = []
+                                async for ev in stream_attempt(retry_opts, f"Retry 1 ({MODEL_RETRY})", 1, attempt_result):
+                                    yield ev
+                                text2, stop2, usage2 = attempt_result[0]
+                                streamed_response = text2
 
                                 done_payload['retry_used'] = True
                                 done_payload['retry_usage'] = usage2
@@ -682,7 +2186,7 @@ def chat(request):
 
                                 if stop2 == 'refusal':
                                     # Retry 2: Sonnet, no thinking, minimal context
-                                    yield f"data: {json.dumps({'type': 'retry', 'attempt': 2, 'model': MODEL_FAST, 'reason': 'Still blocked — trying a faster model'})}\n\n"
+                                    yield sse_event({'type': 'retry', 'attempt': 2, 'model': MODEL_FAST, 'reason': 'Still blocked — trying a faster model'})
                                     minimal_msgs = []
                                     if all_messages:
                                         if all_messages[0].get('role') == 'user':
@@ -695,7 +2199,11 @@ def chat(request):
                                     sonnet_opts['messages'] = minimal_msgs
                                     sonnet_opts.pop('thinking', None)
                                     print(f"Retry 1 also refused — retry 2 (Sonnet, minimal context: {len(minimal_msgs)} msgs)")
-                                    text3, stop3, usage3 = run_attempt(sonnet_opts, "Retry 2 (Sonnet)")
+                                    attempt_result = []
+                                    async for ev in stream_attempt(sonnet_opts, "Retry 2 (Sonnet)", 2, attempt_result):
+                                        yield ev
+                                    text3, stop3, usage3 = attempt_result[0]
+                                    streamed_response = text3
                                     done_payload['retry2_usage'] = usage3
                                     done_payload['retry2_stop_reason'] = stop3
                                     done_payload['retry2_model'] = MODEL_FAST
@@ -711,25 +2219,67 @@ def chat(request):
                                     full_response = text2
 
                             done_payload['content'] = full_response
+                            if done_payload.get('gave_up') and wrappers:
+                                wrappers[-1].cancel()
+                                wrappers.clear()
                         except Exception as retry_err:
                             print(f"Retry chain failed: {retry_err}")
+                            if wrappers:
+                                wrappers[-1].cancel()
+                                wrappers.clear()
                             if not full_response.strip():
                                 full_response = ("I wasn't able to get a response. Please try again.")
                                 done_payload['content'] = full_response
 
-                    yield f"data: {json.dumps(done_payload)}\n\n"
+                    # The answer's remaining paragraphs: everything but the tail is usually wrapped by
+                    # now, so this waits for roughly one paragraph.
+                    if wrappers:
+                        async for wrapped_event in wrappers[-1].drain():
+                            yield wrapped_event
+                        done_payload['wrapped'] = wrappers[-1].summary()
+
+                    timing['total'] = since_start_ms()
+                    done_payload['timing'] = timing
+                    log_request(stop_reason=done_payload.get('stop_reason'), usage=usage,
+                                retries=2 if 'retry2_model' in done_payload else int('retry_model' in done_payload),
+                                gave_up=bool(done_payload.get('gave_up')))
+
+                    # Slim done: the client already holds text it received as chunks, so repeating
+                    # it doubled the bytes of every answer. Only text that was actually streamed as
+                    # the last attempt is slimmed — a canned give-up message is still sent in full.
+                    if slim_done:
+                        if done_payload['content'] == streamed_response:
+                            slim_text_fields(done_payload, 'content')
+                        if stream_thinking and done_payload.get('thinking'):
+                            slim_text_fields(done_payload, 'thinking')
+
+                    yield sse_event(done_payload)
 
             except Exception as e:
                 print(f"Streaming error: {str(e)}")
-                yield f"data: {json.dumps({'type': 'error', 'error': str(e)})}\n\n"
+                timing['total'] = since_start_ms()
+                log_request(error=str(e))
+                yield sse_event({'type': 'error', 'error': str(e)})
 
         # Return streaming response with proper headers
-        from flask import Response
-        return Response(generate(), mimetype='text/event-stream', headers={
-            'Cache-Control': 'no-cache',
-            'X-Accel-Buffering': 'no'
-        })
+        headers = {
+            'Server-Timing': server_timing(timing),
+            'Timing-Allow-Origin': '*',   # lets the page read Server-Timing cross-origin
+        }
+        events = generate()
+        if flight is not None:
+            flight.start(events, transport, loop)
+            events = flight.follow()
+        return sse_response(events, transport, headers)
 
     except Exception as e:
         print(f"Error in chat function: {str(e)}")
+        if flight is not None:
+            flight.fail(str(e))
         return {'error': str(e)}, 500
+
+
+# Module import time, from the first line of this file: the part of a cold start this code
+# controls. Logged once per instance and returned by the warmup route.
+IMPORT_SECONDS = time.perf_counter() - _IMPORT_STARTED
+print(f"chat module imported in {IMPORT_SECONDS:.3f}s")
@@ -35,16 +35,25 @@ deploy_function() {
     ACCESS=(--no-allow-unauthenticated); MIN=0; MEM=2Gi
   fi
 
+  # CHAT_ASGI=1 ./deploy.sh chat serves chat_async under the ASGI server instead of chat under
+  # Flask: streams are awaited rather than holding a thread each, so one instance can take many
+  # concurrent requests.
+  local ENTRY="$FUNCTION_NAME" ENV_VARS="GOOGLE_CLOUD_PROJECT=$PROJECT_ID" CONCURRENCY=()
+  if [ "$FUNCTION_NAME" = "chat" ] && [ "${CHAT_ASGI:-0}" = "1" ]; then
+    ENTRY=chat_async; ENV_VARS="$ENV_VARS,FUNCTION_USE_ASGI=1"; CONCURRENCY=(--concurrency=80)
+  fi
+
   gcloud functions deploy "$FUNCTION_NAME" \
     --gen2 \
     --runtime=python311 \
     --region="$REGION" \
     --source=. \
-    --entry-point="$FUNCTION_NAME" \
+    --entry-point="$ENTRY" \
     --trigger-http \
     "${ACCESS[@]}" \
     --project="$PROJECT_ID" \
-    --set-env-vars=GOOGLE_CLOUD_PROJECT="$PROJECT_ID" \
+    --set-env-vars="$ENV_VARS" \
+    ${CONCURRENCY[@]+"${CONCURRENCY[@]}"} \
     --cpu=1 \
     --memory="$MEM" \
     --min-instances="$MIN" \
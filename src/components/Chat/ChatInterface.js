@@ -8,6 +8,7 @@ import StarredChats from './StarredChats';
 import { useChat } from '../../hooks/useChat';
 import { useFirestore } from '../../hooks/useFirestore';
 import { updateMessage, deleteMessage, touchChatOpened } from '../../services/firebase';
+import { warmUpChatFunction } from '../../services/messageService';
 import './ChatInterface.css';
 
 function ChatInterface({ user, onThemeToggle, theme }) {
@@ -39,6 +40,9 @@ function ChatInterface({ user, onThemeToggle, theme }) {
   const previousMessagesLength = useRef(0);
   const isStreamingRef = useRef(false);
 
+  // Start a chat function instance before the first message needs one.
+  useEffect(() => { warmUpChatFunction(); }, []);
+
   const scrollToBottom = (behavior = 'smooth') => {
     if (messagesEndRef.current) {
       messagesEndRef.current.scrollIntoView({ behavior, block: 'end' });
@@ -159,7 +159,7 @@ export function useChat(userId, selectedChatId = null, selectedChatConfig = {})
     let finalResponse = null;
     let lastWrite = 0;
 
-    const stream = streamMessageToClaud(history, content || '', image, config);
+    const stream = streamMessageToClaud(history, content || '', image, { ...config, userId });
 
     for await (const data of stream) {
       if (data.type === 'chunk') {
@@ -171,6 +171,8 @@ export function useChat(userId, selectedChatId = null, selectedChatConfig = {})
             { content: fullContent, isStreaming: true }, { touchChat: false });
         }
       } else if (data.type === 'retry') {
+        // The server streams each fallback attempt from scratch; drop the refused attempt's text.
+        fullContent = '';
         lastWrite = Date.now();
         await updateMessage(userId, chatId, messageId,
           { content: fullContent, isStreaming: true, retryStatus: data.reason }, { touchChat: false });
@@ -0,0 +1,280 @@
+"""A local stand-in for Claude on Vertex AI, for offline load tests of the chat function.
+
+Speaks enough of the Anthropic Messages protocol, as Vertex serves it, for the SDK's
+AnthropicVertex / AsyncAnthropicVertex clients:
+
+    POST /v1/projects/{p}/locations/{r}/publishers/anthropic/models/{model}:streamRawPredict
+         SSE: message_start, a thinking block (when the request enables thinking), a text
+         block, message_delta with stop_reason and usage, message_stop.
+    POST .../models/{model}:rawPredict
+         the same message as one JSON body (the wrap modes' messages.create).
+    POST .../models/count-tokens:rawPredict (and .../models/{model}:countTokens)
+         {"input_tokens": N} at once, so chat's warmup step — a messages.count_tokens call —
+         succeeds. Not counted as a request, and never failed by --error-rate.
+    HEAD / GET /
+         200; GET returns the request counts.
+
+Timing, token rates and failures are configurable, so the chat function's own overhead can be
+measured against a model whose behaviour is known and costs nothing:
+
+    --ttft-ms           delay before the first event (default 800)
+    --jitter            ± fraction applied to every delay and count (default 0.2)
+    --thinking-tokens   thinking tokens when thinking is on (default 300)
+    --thinking-rate     thinking tokens per second (default 150)
+    --text-tokens       text tokens (default 400)
+    --text-rate         text tokens per second (default 80)
+    --refusal-rate      share of streams that stop with stop_reason "refusal" a few tokens into
+                        the text (default 0)
+    --error-rate        share of requests answered 529 overloaded_error before any event
+                        (default 0). The SDK retries these itself (max_retries=2).
+    --stream-error-rate share of streams that send an SSE error event part-way (default 0)
+    --seed              RNG seed, for repeatable runs
+
+Point the chat function at it with:
+
+    ANTHROPIC_VERTEX_BASE_URL=http://127.0.0.1:8089/v1 VERTEX_ACCESS_TOKEN=fake
+
+load_test_chat.py starts it in-process by default (see serve()).
+
+Usage:
+    python test_scripts/fake_vertex.py --port 8089 --refusal-rate 0.05
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROUTE = re.compile(r"/models/(?P<model>[^/:]+):(?P<method>streamRawPredict|rawPredict|countTokens)$")
+
+# Words the fake model "says"; every word is one output token.
+WORDS = ("the quick brown fox jumps over a lazy dog while 小明 reads 一本 書 aloud").split()
+
+
+class Behaviour:
+    def __init__(self, ttft_ms=800, jitter=0.2, thinking_tokens=300, thinking_rate=150,
+                 text_tokens=400, text_rate=80, refusal_rate=0.0, error_rate=0.0,
+                 stream_error_rate=0.0, seed=None):
+        self.ttft_ms = ttft_ms
+        self.jitter = jitter
+        self.thinking_tokens = thinking_tokens
+        self.thinking_rate = thinking_rate
+        self.text_tokens = text_tokens
+        self.text_rate = text_rate
+        self.refusal_rate = refusal_rate
+        self.error_rate = error_rate
+        self.stream_error_rate = stream_error_rate
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.counts = {'requests': 0, 'streams': 0, 'refusals': 0, 'errors': 0, 'stream_errors': 0}
+
+    def roll(self, rate):
+        with self.rng_lock:
+            return self.rng.random() < rate
+
+    def vary(self, value):
+        with self.rng_lock:
+            return value * (1 + self.rng.uniform(-self.jitter, self.jitter))
+
+    def count(self, key):
+        with self.rng_lock:
+            self.counts[key] += 1
+
+
+def estimate_input_tokens(body):
+    """~4 bytes per token of the request JSON; base64 attachments inflate it, which is fine for
+    a stand-in."""
+    return max(1, len(json.dumps(body.get('system', '')) + json.dumps(body.get('messages', []))) // 4)
+
+
+def words(n):
+    return [WORDS[i % len(WORDS)] + ' ' for i in range(max(0, int(n)))]
+
+
+def make_handler(behaviour):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def do_GET(self):
+            self.send_json(200, {'fake_vertex': True, 'counts': behaviour.counts})
+
+        def send_json(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            match = ROUTE.search(self.path)
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            if not match:
+                return self.send_json(404, {'type': 'error', 'error': {
+                    'type': 'not_found_error', 'message': f'no route for {self.path}'}})
+            if match['method'] == 'countTokens' or match['model'] == 'count-tokens':
+                return self.send_json(200, {'input_tokens': estimate_input_tokens(body)})
+            behaviour.count('requests')
+            if behaviour.roll(behaviour.error_rate):
+                behaviour.count('errors')
+                time.sleep(behaviour.vary(behaviour.ttft_ms) / 4000)
+                return self.send_json(529, {'type': 'error', 'error': {
+                    'type': 'overloaded_error', 'message': 'Overloaded (fake_vertex)'}})
+            model = match['model']
+            if match['method'] == 'rawPredict':
+                return self.create(model, body)
+            self.stream(model, body)
+
+        def create(self, model, body):
+            """messages.create: the whole reply after TTFT plus the text generation time. Echoes
+            the last user text, so the wrap modes return something shaped like their input."""
+            last = (body.get('messages') or [{}])[-1].get('content')
+            if isinstance(last, list):
+                last = ''.join(b.get('text', '') for b in last if b.get('type') == 'text')
+            text = last or ''.join(words(behaviour.text_tokens))
+            out = max(1, len(text) // 4)
+            time.sleep((behaviour.vary(behaviour.ttft_ms) / 1000)
+                       + out / max(1, behaviour.vary(behaviour.text_rate)))
+            self.send_json(200, {
+                'id': f'msg_fake_{uuid.uuid4().hex[:20]}', 'type': 'message', 'role': 'assistant',
+                'model': model, 'content': [{'type': 'text', 'text': text}],
+                'stop_reason': 'end_turn', 'stop_sequence': None,
+                'usage': {'input_tokens': estimate_input_tokens(body), 'output_tokens': out,
+                          'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}})
+
+        def event(self, kind, payload):
+            data = f"event: {kind}\ndata: {json.dumps({'type': kind, **payload})}\n\n".encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def deltas(self, index, kind, tokens, rate):
+            """Emit `tokens` deltas at `rate` tokens/s, paced against the clock rather than slept
+            per token, so a busy host falls behind by less than the sum of its oversleeps."""
+            started = time.perf_counter()
+            for i, word in enumerate(tokens):
+                due = started + i / rate
+                wait = due - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+                delta = ({'type': 'thinking_delta', 'thinking': word} if kind == 'thinking'
+                         else {'type': 'text_delta', 'text': word})
+                self.event('content_block_delta', {'index': index, 'delta': delta})
+
+        def stream(self, model, body):
+            behaviour.count('streams')
+            thinking = (body.get('thinking') or {}).get('type') in ('enabled', 'adaptive')
+            refuse = behaviour.roll(behaviour.refusal_rate)
+            fail = behaviour.roll(behaviour.stream_error_rate)
+            n_thinking = behaviour.vary(behaviour.thinking_tokens) if thinking else 0
+            n_text = 5 if refuse else behaviour.vary(behaviour.text_tokens)
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Cache-Control', 'no-cache')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                time.sleep(behaviour.vary(behaviour.ttft_ms) / 1000)
+                input_tokens = estimate_input_tokens(body)
+                self.event('message_start', {'message': {
+                    'id': f'msg_fake_{uuid.uuid4().hex[:20]}', 'type': 'message',
+                    'role': 'assistant', 'model': model, 'content': [], 'stop_reason': None,
+                    'stop_sequence': None,
+                    'usage': {'input_tokens': input_tokens, 'output_tokens': 1,
+                              'cache_creation_input_tokens': 0, 'cache_read_input_tokens': 0}}})
+                index = 0
+                if n_thinking:
+                    self.event('content_block_start', {'index': index, 'content_block': {
+                        'type': 'thinking', 'thinking': '', 'signature': ''}})
+                    self.deltas(index, 'thinking', words(n_thinking),
+                                max(1, behaviour.vary(behaviour.thinking_rate)))
+                    self.event('content_block_delta', {'index': index, 'delta': {
+                        'type': 'signature_delta', 'signature': 'fake-signature'}})
+                    self.event('content_block_stop', {'index': index})
+                    index += 1
+                text = words(n_text)
+                if fail:
+                    text = text[:len(text) // 2]
+                self.event('content_block_start', {'index': index, 'content_block': {
+                    'type': 'text', 'text': ''}})
+                self.deltas(index, 'text', text, max(1, behaviour.vary(behaviour.text_rate)))
+                if fail:
+                    behaviour.count('stream_errors')
+                    self.event('error', {'error': {
+                        'type': 'overloaded_error', 'message': 'Overloaded mid-stream (fake_vertex)'}})
+                else:
+                    self.event('content_block_stop', {'index': index})
+                    stop = 'refusal' if refuse else 'end_turn'
+                    if refuse:
+                        behaviour.count('refusals')
+                    self.event('message_delta', {
+                        'delta': {'stop_reason': stop, 'stop_sequence': None},
+                        'usage': {'output_tokens': int(n_thinking) + len(text)}})
+                    self.event('message_stop', {})
+                self.wfile.write(b"0\r\n\r\n")
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                pass   # the client abandoned the stream (chat does this on a refusal signal)
+            self.close_connection = True
+
+    return Handler
+
+
+def serve(port=0, host='127.0.0.1', **behaviour):
+    """Start the fake in a background thread. Returns (server, base_url, Behaviour); base_url is
+    what ANTHROPIC_VERTEX_BASE_URL should be set to."""
+    state = Behaviour(**behaviour)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1", state
+
+
+def add_behaviour_args(ap):
+    ap.add_argument('--ttft-ms', type=float, default=800)
+    ap.add_argument('--jitter', type=float, default=0.2)
+    ap.add_argument('--thinking-tokens', type=int, default=300)
+    ap.add_argument('--thinking-rate', type=float, default=150)
+    ap.add_argument('--text-tokens', type=int, default=400)
+    ap.add_argument('--text-rate', type=float, default=80)
+    ap.add_argument('--refusal-rate', type=float, default=0.0)
+    ap.add_argument('--error-rate', type=float, default=0.0)
+    ap.add_argument('--stream-error-rate', type=float, default=0.0)
+    ap.add_argument('--seed', type=int, default=None)
+
+
+def behaviour_kwargs(args):
+    return {k: getattr(args, k) for k in (
+        'ttft_ms', 'jitter', 'thinking_tokens', 'thinking_rate', 'text_tokens', 'text_rate',
+        'refusal_rate', 'error_rate', 'stream_error_rate', 'seed')}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=8089)
+    add_behaviour_args(ap)
+    args = ap.parse_args()
+    server, base_url, _ = serve(args.port, args.host, **behaviour_kwargs(args))
+    print(f"fake_vertex listening; export ANTHROPIC_VERTEX_BASE_URL={base_url} VERTEX_ACCESS_TOKEN=fake")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
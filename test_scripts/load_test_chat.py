@@ -0,0 +1,266 @@
+"""Load-test the chat function offline: N concurrent users against fake_vertex.py.
+
+Each user sends chat requests back to back and reads the SSE stream to the end, timing:
+
+    ttfb           first SSE event of any kind (headers + first bytes)
+    ttft_thinking  first 'thinking_chunk' (only with --stream-thinking)
+    ttft           first 'chunk' — the first answer text the reader sees
+    total          the 'done' (or 'error') event
+    tok/s          output tokens from the done event's usage / (total - ttft)
+
+and the run reports p50/p90/p99/max of each, plus requests/s and aggregate output tokens/s over
+the wall-clock run, retries (refusals the function re-asked) and errors.
+
+By default chat() is loaded in-process from functions/chat/main.py through functions_framework's
+own Flask app — the same routing and streaming the deployed function uses — with a fake_vertex
+server started on a free port. No Google credentials and no paid model calls. The fake's
+behaviour flags (--ttft-ms, --text-rate, --refusal-rate, ...) are the ones fake_vertex.py takes.
+
+--url instead drives an already-running function over HTTP, e.g. one started locally with
+
+    ANTHROPIC_VERTEX_BASE_URL=http://127.0.0.1:8089/v1 VERTEX_ACCESS_TOKEN=fake \\
+        functions-framework --source functions/chat/main.py --target chat_async --asgi --port 8080
+
+against `python test_scripts/fake_vertex.py --port 8089`, which is how the ASGI handler is
+measured. Only text prompts are sent, so neither mode touches Storage.
+
+Usage:
+    source functions/chat/.venv/bin/activate
+    python test_scripts/load_test_chat.py --users 20 --requests 5
+    python test_scripts/load_test_chat.py --users 50 --duration 60 --refusal-rate 0.05 --json out.json
+    python test_scripts/load_test_chat.py --url http://127.0.0.1:8080 --users 80 --requests 3
+"""
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_vertex  # noqa: E402
+
+CHAT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'chat', 'main.py')
+
+PROMPTS = [
+    "For the following phrases give me just the Mandarin and authentic colloquial Cantonese "
+    "equivalent, with their pinyin and jyutping respectively: I will put on the brakes",
+    "Explain the grammar of 我哋今晚去邊度食飯 for a learner.",
+    "Translate this page of a children's book into colloquial Cantonese: The little fox ran "
+    "to the river, where the moon was waiting.",
+]
+
+
+def build_request(user, i, args):
+    messages = []
+    for turn in range(args.history):
+        messages.append({'role': 'user', 'content': PROMPTS[turn % len(PROMPTS)]})
+        messages.append({'role': 'assistant', 'content': 'An earlier answer. ' * 40})
+    messages.append({'role': 'user', 'content': f"{PROMPTS[(user + i) % len(PROMPTS)]} (user {user}, #{i})"})
+    body = {'messages': messages, 'slim_done': True}
+    if args.no_thinking:
+        body['disable_thinking'] = True
+    if args.stream_thinking:
+        body['stream_thinking'] = True
+    if args.fast:
+        body['use_fast_model'] = True
+    return body
+
+
+def in_process_sender():
+    """A send(body) that posts to chat() through functions_framework's Flask app and yields the
+    response body as it streams."""
+    import functions_framework
+    app = functions_framework.create_app(target='chat', source=os.path.abspath(CHAT_SOURCE))
+    local = threading.local()
+
+    def send(body):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        response = local.client.post('/', json=body, buffered=False)
+        try:
+            yield from response.iter_encoded()
+        finally:
+            response.close()
+    return send
+
+
+def http_sender(url):
+    import httpx
+    local = threading.local()
+
+    def send(body):
+        if not hasattr(local, 'client'):
+            local.client = httpx.Client(timeout=600)
+        with local.client.stream('POST', url, json=body) as response:
+            yield from response.iter_bytes()
+    return send
+
+
+def run_one(send, body):
+    """Send one request; return its timings in seconds and what the stream ended with."""
+    started = time.perf_counter()
+    out = {'ttfb': None, 'ttft_thinking': None, 'ttft': None, 'total': None, 'output_tokens': 0,
+           'retries': 0, 'error': None, 'stop_reason': None}
+    buffer = b''
+    try:
+        for part in send(body):
+            now = time.perf_counter() - started
+            buffer += part
+            while b'\n\n' in buffer:
+                frame, buffer = buffer.split(b'\n\n', 1)
+                line = frame.decode('utf-8', 'replace').strip()
+                if not line.startswith('data: '):
+                    continue
+                event = json.loads(line[6:])
+                kind = event.get('type')
+                if out['ttfb'] is None:
+                    out['ttfb'] = now
+                if kind == 'thinking_chunk' and out['ttft_thinking'] is None:
+                    out['ttft_thinking'] = now
+                elif kind == 'chunk' and out['ttft'] is None:
+                    out['ttft'] = now
+                elif kind == 'retry':
+                    out['retries'] += 1
+                elif kind == 'done':
+                    out['total'] = now
+                    out['output_tokens'] = (event.get('usage') or {}).get('output_tokens') or 0
+                    out['stop_reason'] = event.get('stop_reason')
+                elif kind == 'error':
+                    out['total'] = now
+                    out['error'] = str(event.get('error'))[:200]
+        if out['total'] is None:
+            out['error'] = out['error'] or 'stream ended without done'
+    except Exception as e:
+        out['error'] = f"{type(e).__name__}: {e}"[:200]
+    if out['total'] is None:
+        out['total'] = time.perf_counter() - started
+    return out
+
+
+def percentiles(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return None
+
+    def at(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+    return {'n': len(values), 'p50': at(0.50), 'p90': at(0.90), 'p99': at(0.99), 'max': values[-1]}
+
+
+def report(results, wall_s, fake_counts=None):
+    ok = [r for r in results if not r['error']]
+    rates = [r['output_tokens'] / (r['total'] - r['ttft'])
+             for r in ok if r['ttft'] is not None and r['total'] > r['ttft'] and r['output_tokens']]
+    summary = {
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': len(results) - len(ok),
+        'retried': sum(1 for r in results if r['retries']),
+        'wall_s': round(wall_s, 2),
+        'requests_per_s': round(len(ok) / wall_s, 2) if wall_s else None,
+        'output_tokens_per_s': round(sum(r['output_tokens'] for r in ok) / wall_s, 1) if wall_s else None,
+        'latency_s': {key: percentiles([r[key] for r in ok])
+                      for key in ('ttfb', 'ttft_thinking', 'ttft', 'total')},
+        'per_request_tokens_per_s': percentiles(rates),
+    }
+    if fake_counts:
+        summary['fake_vertex'] = dict(fake_counts)
+    errors = {}
+    for r in results:
+        if r['error']:
+            errors[r['error']] = errors.get(r['error'], 0) + 1
+    if errors:
+        summary['error_kinds'] = errors
+    return summary
+
+
+def print_report(summary):
+    print(f"\nrequests={summary['requests']} ok={summary['ok']} errors={summary['errors']} "
+          f"retried={summary['retried']} wall={summary['wall_s']}s "
+          f"req/s={summary['requests_per_s']} out_tok/s={summary['output_tokens_per_s']}")
+    print(f"{'':16}{'n':>6}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    rows = dict(summary['latency_s'], **{'tok/s per req': summary['per_request_tokens_per_s']})
+    for name, p in rows.items():
+        if p:
+            print(f"{name:16}{p['n']:>6}" + ''.join(f"{p[k]:>9.3f}" for k in ('p50', 'p90', 'p99', 'max')))
+    for kind, n in (summary.get('error_kinds') or {}).items():
+        print(f"  error x{n}: {kind}")
+    if summary.get('fake_vertex'):
+        print(f"fake_vertex: {json.dumps(summary['fake_vertex'])}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--users', type=int, default=10, help='concurrent users (default 10)')
+    ap.add_argument('--requests', type=int, default=3, help='requests per user (default 3)')
+    ap.add_argument('--duration', type=float, default=None,
+                    help='run for this many seconds instead of a fixed request count')
+    ap.add_argument('--ramp', type=float, default=0.0, help='seconds over which users start')
+    ap.add_argument('--history', type=int, default=0, help='prior user/assistant exchanges per request')
+    ap.add_argument('--no-thinking', action='store_true')
+    ap.add_argument('--stream-thinking', action='store_true')
+    ap.add_argument('--fast', action='store_true', help='use_fast_model')
+    ap.add_argument('--no-warmup', action='store_true',
+                    help='time the cold first requests too (default: one untimed request first)')
+    ap.add_argument('--url', default=None, help='drive a running function over HTTP instead')
+    ap.add_argument('--fake-port', type=int, default=0, help='port for the in-process fake (0 = free)')
+    ap.add_argument('--json', default=None, help='also write the summary and raw results here')
+    fake_vertex.add_behaviour_args(ap)
+    args = ap.parse_args()
+
+    fake_state = None
+    if args.url:
+        send = http_sender(args.url)
+    else:
+        # Before chat's module is loaded: it builds its Vertex client from these on first use.
+        _, base_url, fake_state = fake_vertex.serve(args.fake_port, **fake_vertex.behaviour_kwargs(args))
+        os.environ['ANTHROPIC_VERTEX_BASE_URL'] = base_url
+        os.environ['VERTEX_ACCESS_TOKEN'] = 'fake'
+        print(f"fake_vertex at {base_url}")
+        send = in_process_sender()
+
+    if not args.no_warmup:
+        # Kept off the single-flight map: otherwise user 0's first measured request, the same
+        # body, would follow this one's lingering flight instead of streaming.
+        warm = run_one(send, {**build_request(0, 0, args), 'coalesce': False})
+        print(f"warmup request: {warm['total']:.2f}s{' ' + warm['error'] if warm['error'] else ''}")
+        if fake_state:
+            fake_state.counts.update({k: 0 for k in fake_state.counts})
+
+    results, lock = [], threading.Lock()
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    def user(u):
+        if args.ramp and args.users > 1:
+            time.sleep(args.ramp * u / (args.users - 1))
+        i = 0
+        while (time.perf_counter() < deadline) if deadline else (i < args.requests):
+            result = run_one(send, build_request(u, i, args))
+            result['user'] = u
+            with lock:
+                results.append(result)
+                done = len(results)
+            if done % max(1, args.users) == 0:
+                print(f"  {done} requests done", flush=True)
+            i += 1
+
+    print(f"{args.users} users x {f'{args.duration}s' if deadline else f'{args.requests} requests'}"
+          f" -> {args.url or 'in-process chat()'}")
+    started = time.perf_counter()
+    threads = [threading.Thread(target=user, args=(u,), daemon=True) for u in range(args.users)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    summary = report(results, time.perf_counter() - started, fake_state.counts if fake_state else None)
+    print_report(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'summary': summary, 'results': results}, f, indent=2)
+        print(f"wrote {args.json}")
+
+
+if __name__ == '__main__':
+    main()
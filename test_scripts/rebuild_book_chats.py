@@ -35,6 +35,17 @@ def main():
     ap.add_argument("--apply", action="store_true", help="write to Firestore (default: dry run)")
     ap.add_argument("--history-pages", type=int, default=pipeline.HISTORY_PAGES,
                     help="previous pages carried as context (0 = stateless)")
+    ap.add_argument("--segment-pages", type=int, default=pipeline.SEGMENT_PAGES,
+                    help="pass 2 runs the book in segments of about this many pages in parallel "
+                         "(0 = one segment, strictly in order)")
+    ap.add_argument("--no-reuse", action="store_true",
+                    help="re-translate every page even where its stored input fingerprint matches")
+    ap.add_argument("--pipeline-version", default="",
+                    help="book_qa's PIPELINE_VERSION, so the stored fingerprints match the ones the "
+                         "nightly run writes (default: none, which never matches them)")
+    ap.add_argument("--incremental", action="store_true",
+                    help="for a book that gained pages since it was rebuilt: translate only the "
+                         "new pages and those the revised sheet reaches")
     ap.add_argument("--strip-asides", action="store_true",
                     help="delete typed turns + their replies, leaving only photo -> translation")
     ap.add_argument("--delete-surplus", action="store_true",
@@ -90,7 +101,9 @@ def main():
         try:
             r = pipeline.process_chat(db, cid, templates, args.model, backup_dir, args.apply,
                              img_cache, args.delete_surplus, args.history_pages,
-                             log=lines.append)
+                             log=lines.append, segment_pages=args.segment_pages,
+                             reuse=not args.no_reuse, incremental=args.incremental,
+                             version=args.pipeline_version)
         except Exception as e:  # noqa: BLE001
             lines.append(f"[{cid[:10]}] FATAL {type(e).__name__}: {e}")
             r = {"chat_id": cid, "title": "?", "skipped": None, "errors": 1, "pages": 0,
@@ -116,10 +129,14 @@ def main():
         flag = "" if (v is None or v["ok"]) else "  <-- VERIFY FAILED"
         if r.get("drift"):
             flag += f"  <-- {len(r['drift'])} DRIFT"
+        seams = [b for b in (r.get("boundary_drift") or []) if b["drift"]]
+        if seams:
+            flag += f"  <-- drift at segment boundary p{', p'.join(str(b['boundary']) for b in seams)}"
         if v is not None and not v["ok"]:
             bad += 1
         print(f"  [{r['chat_id'][:10]}] {str(r.get('title'))[:34]:34} pages={r['pages']:3d} "
               f"rebuilt={r['rebuilt']:3d} created={r['created']:2d} deleted={r['deleted']:2d} "
+              f"reused={r.get('pages_reused') or 0:3d} "
               f"sheet={r.get('sheet_terms',0)}t/{r.get('sheet_refrains',0)}r "
               f"errors={r['errors']:2d}{flag}")
         for d in (r.get("drift") or [])[:4]:
@@ -26,11 +26,21 @@ Common flags:
     --chat CHATID         Restrict to a single conversation. Strongly
                           recommended for the first verification run.
     --limit N             Cap total messages processed.
-    --workers N           Parallel Claude calls (default 8).
+    --workers N           Parallel function calls (default 8).
+    --batch N             Messages per function call (default 25, max 100).
+                          Each call fans its batch out server-side with the
+                          WRAP_PROMPT cached, so a backfill makes ~N× fewer
+                          HTTP calls and pays 0.1× for the prompt after the
+                          first item. --batch 1 uses the single wrap_content
+                          form.
     --fast                Use Sonnet 4.6 instead of Opus 4.7 (cheaper, faster,
                           slightly less accurate).
     --force               Re-process from contentOriginal even if already
                           wrapped. Use after prompt updates to re-wrap.
+                          Model results are cached server-side per
+                          (input, WRAP_PROMPT version, model), so a --force
+                          re-run with an unchanged prompt costs no model
+                          calls; editing WRAP_PROMPT invalidates the cache.
 
 Re-running is safe: docs that already have `contentOriginal` are skipped
 unless --force is used.
@@ -75,6 +85,25 @@ def wrap_one(content: str, use_fast: bool = True) -> str:
     return data.get("wrapped", content)
 
 
+def wrap_many(contents: list, use_fast: bool = True) -> list:
+    """POST a batch to wrap_contents. Returns one (wrapped, error) per content, in order."""
+    payload = json.dumps({"wrap_contents": contents, "use_fast_model": use_fast}).encode()
+    req = urllib.request.Request(
+        CLOUD_FUNCTION_URL,
+        data=payload,
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req, timeout=600) as resp:
+        data = json.loads(resp.read())
+    out = []
+    for content, r in zip(contents, data["results"]):
+        if "error" in r:
+            out.append((None, RuntimeError(r["error"])))
+        else:
+            out.append((r.get("wrapped", content), None))
+    return out
+
+
 def collect_targets(db, only_user, only_chat, force=False):
     """Walk the Firestore tree and return list of (msg_ref, content) for
     every assistant message that needs processing (has CJK, no contentOriginal).
@@ -122,7 +151,7 @@ def backfill(args) -> int:
     print(
         f"Mode={'DRY RUN' if args.dry_run else 'LIVE'}  "
         f"project={args.project}  user={args.user or 'ALL'}  "
-        f"chat={args.chat or 'ALL'}  workers={args.workers}  "
+        f"chat={args.chat or 'ALL'}  workers={args.workers}  batch={args.batch}  "
         f"model={'fast (Sonnet 4.6)' if args.fast else 'default (Opus 4.7)'}"
     )
 
@@ -163,18 +192,22 @@ def backfill(args) -> int:
                 print(f"  committed batch of {len(slab)} update(s)")
         pending_writes = []
 
-    def process(target):
-        ref, content = target
+    def process(chunk):
         try:
-            wrapped = wrap_one(content, use_fast=args.fast)
-            return ref, content, wrapped, None
+            if len(chunk) == 1:
+                outcomes = [(wrap_one(chunk[0][1], use_fast=args.fast), None)]
+            else:
+                outcomes = wrap_many([content for _, content in chunk], use_fast=args.fast)
         except Exception as e:
-            return ref, content, None, e
+            outcomes = [(None, e)] * len(chunk)
+        return [(ref, content, wrapped, err) for (ref, content), (wrapped, err) in zip(chunk, outcomes)]
 
+    batch_size = max(1, min(args.batch, 100))
+    chunks = [targets[i : i + batch_size] for i in range(0, len(targets), batch_size)]
     with cf.ThreadPoolExecutor(max_workers=args.workers) as pool:
-        futs = [pool.submit(process, t) for t in targets]
-        for i, fut in enumerate(cf.as_completed(futs), 1):
-            ref, content, wrapped, err = fut.result()
+        futs = [pool.submit(process, c) for c in chunks]
+        done = (item for fut in cf.as_completed(futs) for item in fut.result())
+        for i, (ref, content, wrapped, err) in enumerate(done, 1):
             if err is not None:
                 error_count += 1
                 print(f"[{i}/{len(targets)}] ERROR {ref.path}: {err}")
@@ -224,7 +257,8 @@ def main():
     parser.add_argument("--user", default=None, help="Restrict to one uid")
     parser.add_argument("--chat", default=None, help="Restrict to one chat id")
     parser.add_argument("--limit", type=int, default=None, help="Cap total messages")
-    parser.add_argument("--workers", type=int, default=8, help="Parallel Claude calls")
+    parser.add_argument("--workers", type=int, default=8, help="Parallel function calls")
+    parser.add_argument("--batch", type=int, default=25, help="Messages per function call")
     parser.add_argument("--fast", action="store_true", help="Use Sonnet 4.6 not Opus 4.7")
     parser.add_argument("--force", action="store_true", help="Re-process even if contentOriginal already set")
     args = parser.parse_args()